@@ -0,0 +1,614 @@
+"""Benchmarks for rms and pms.
+
+Run from the directory that contains train.csv and store.csv, e.g.
+
+    python bench.py snapshot
+
+The suite runs on generated data instead and compares against a baseline:
+
+    python bench.py suite --stores 200 --save-baseline bench_baseline.json
+    python bench.py suite --stores 200 --baseline bench_baseline.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+import rms
+
+
+def timeit(func, repeat=3):
+    """Call func repeat times and return the best wall time in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _cold_train_load(use_snapshot):
+    """Load train.csv with an empty cache, either from csv or from the snapshot."""
+    rms.USE_SNAPSHOT = use_snapshot
+    rms.invalidate_cache()
+    rms.get_train_df()
+
+
+def bench_snapshot(repeat=3):
+    """Compare cold csv loads, cold snapshot loads and warm (cached) loads of get_train_df."""
+    use_snapshot = rms.USE_SNAPSHOT
+    try:
+        rms.write_snapshot()
+        results = {
+            "csv (cold)": timeit(lambda: _cold_train_load(False), repeat),
+            "snapshot (cold)": timeit(lambda: _cold_train_load(True), repeat),
+            "cache (warm)": timeit(rms.get_train_df, repeat),
+        }
+    finally:
+        rms.USE_SNAPSHOT = use_snapshot
+
+    return pd.Series(results, name="seconds").to_frame()
+
+
+def _cold_store_load(store_id, use_snapshot):
+    """Build the weekly data of a single store with an empty cache."""
+    rms.USE_SNAPSHOT = use_snapshot
+    rms.invalidate_cache()
+    rms.get_weekly_data(store_id)
+
+
+def bench_single_store(repeat=3, store_id=1):
+    """Compare a cold single-store report from csv with one from the partitioned snapshot."""
+    use_snapshot = rms.USE_SNAPSHOT
+    try:
+        rms.write_snapshot()
+        results = {
+            "csv (all stores)": timeit(lambda: _cold_store_load(store_id, False), repeat),
+            "snapshot (one partition)": timeit(lambda: _cold_store_load(store_id, True), repeat),
+        }
+    finally:
+        rms.USE_SNAPSHOT = use_snapshot
+
+    return pd.Series(results, name="seconds").to_frame()
+
+
+def _get_impact_df_loop(df, data_type="competition"):
+    """The former store-by-store get_impact_df (pre/post sums only), kept as reference."""
+    data_column = f"{data_type.capitalize()}Since"
+    data_stores = df.loc[df[data_column] >= "2013"].index.unique(level="Store").to_list()
+
+    impact_df = pd.DataFrame(columns="store pre_days post_days pre_sales post_sales pre_customers post_customers".split())
+    impact_df = impact_df.set_index("store")
+
+    for store in data_stores:
+        data_since = df.loc[store, data_column].iloc[0]
+        pre_data_df = df.loc[(store, slice(None, data_since)), :]
+        post_data_df = df.loc[(store, slice(data_since, None)), :]
+
+        impact_df.loc[store] = {"pre_days": pre_data_df.shape[0], "post_days": post_data_df.shape[0],
+                                "pre_sales": pre_data_df.Sales.sum(), "post_sales": post_data_df.Sales.sum(),
+                                "pre_customers": pre_data_df.Customers.sum(), "post_customers": post_data_df.Customers.sum()}
+    return impact_df
+
+
+def scale_stores(df, factor):
+    """Repeat all stores of a (Store, Date) indexed frame factor times under new store ids."""
+    n_stores = df.index.get_level_values("Store").max()
+    copies = []
+    for i in range(factor):
+        copy = df.copy()
+        copy.index = copy.index.set_levels(copy.index.levels[0].astype("int64") + i * n_stores, level="Store")
+        copies.append(copy)
+    return pd.concat(copies)
+
+
+def bench_impact(repeat=3, factors=(1, 10)):
+    """Time the vectorized get_impact_df against the former loop for 1x and 10x stores."""
+    data_open_df = rms.get_data_open_df()
+    rows = {}
+    for factor in factors:
+        df = scale_stores(data_open_df, factor)
+        for data_type in ["competition", "promo2"]:
+            loop_df = _get_impact_df_loop(df, data_type)
+            impact_df = rms.get_impact_df(df, data_type)
+            pd.testing.assert_frame_equal(impact_df[loop_df.columns], loop_df, check_dtype=False, check_index_type=False)
+
+            rows[(f"{factor}x", data_type)] = {
+                "stores": len(impact_df),
+                "loop": timeit(lambda: _get_impact_df_loop(df, data_type), 1),
+                "vectorized": timeit(lambda: rms.get_impact_df(df, data_type), repeat),
+            }
+    return pd.DataFrame(rows).T
+
+
+def _build_derived(ids):
+    """Build the frames that append_sales keeps up to date and return them by name."""
+    frames = {"train": rms.get_train_df(), "data": rms.get_data_df(), "data_open": rms.get_data_open_df(),
+              "stores": rms.get_stores_data_df(), "weekly_prediction_bulk": rms.get_weekly_prediction_dfs()}
+    for cuboid, (_, freqs) in rms.ROLLUP_CUBOIDS.items():
+        for freq in freqs:
+            frames[f"rollup {freq} {cuboid}"] = rms.get_rollup_df(freq, cuboid)
+    for id in ids:
+        frames[f"store_data {id}"] = rms.get_store_data_df(id)
+        frames[f"weekly {id}"] = rms.get_weekly_data(id)
+        frames[f"weekly_prediction {id}"] = rms.get_weekly_prediction_df(id)
+    return frames
+
+
+def bench_append(repeat=1, days=14, ids=(1, 2, 20)):
+    """Hold back the last days of train.csv, append them with rms.append_sales and compare to a full rebuild.
+
+    Runs once on csv only and once with a snapshot, where the frames built before the append
+    (memory-mapped from the snapshot) must still hold their old values afterwards.
+    Works on copies in a temporary directory, train.csv itself isn't touched.
+    """
+    train_df = rms.get_train_df().reset_index()
+    split = train_df.Date.max() - pd.Timedelta(days=days - 1)
+    new_rows = train_df.loc[train_df.Date >= split, rms.TRAIN_COLUMNS]
+
+    results = {}
+    for snapshot in [False, True]:
+        paths = rms.TRAIN_CSV, rms.STORE_CSV, rms.SNAPSHOT_DIR
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy(rms.STORE_CSV, tmp_dir)
+            rms.TRAIN_CSV, rms.STORE_CSV, rms.SNAPSHOT_DIR = (os.path.join(tmp_dir, name) for name in ["train.csv", "store.csv", "snapshot"])
+            train_df.loc[train_df.Date < split, rms.TRAIN_COLUMNS].to_csv(rms.TRAIN_CSV, index=False, date_format="%Y-%m-%d")
+
+            rms.invalidate_cache()
+            if snapshot:
+                rms.write_snapshot()
+                rms.invalidate_cache()
+            held = _build_derived(ids)
+            held_copies = {name: df.copy(deep=True) for name, df in held.items()}
+            start = time.perf_counter()
+            rms.append_sales(new_rows)
+            appended = _build_derived(ids)
+            append_time = time.perf_counter() - start
+
+            rms.invalidate_cache()
+            start = time.perf_counter()
+            rebuilt = _build_derived(ids)
+            rebuild_time = time.perf_counter() - start
+
+            for name in rebuilt:
+                pd.testing.assert_frame_equal(appended[name], rebuilt[name], check_freq=False, obj=name)
+                pd.testing.assert_frame_equal(held[name], held_copies[name], check_freq=False, obj=f"held {name}")
+        finally:
+            rms.TRAIN_CSV, rms.STORE_CSV, rms.SNAPSHOT_DIR = paths
+            rms.invalidate_cache()
+            shutil.rmtree(tmp_dir)
+        results["snapshot" if snapshot else "csv"] = {"append (incremental)": append_time, "full rebuild": rebuild_time}
+
+    return pd.DataFrame(results)
+
+
+def peak_memory(func):
+    """Call func and return its wall time in seconds and the peak of traced allocations in MB."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func()
+        return time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 1024**2
+    finally:
+        tracemalloc.stop()
+
+
+def _cold_stores_data(chunksize):
+    """get_stores_data_df from csv with an empty cache, streamed if chunksize is given."""
+    rms.invalidate_cache()
+    rms.get_stores_data_df(chunksize=chunksize)
+
+
+def bench_streaming(repeat=1, chunksizes=(None, 200_000, 50_000)):
+    """Compare time and peak memory of get_stores_data_df in memory and streamed in chunks."""
+    use_snapshot = rms.USE_SNAPSHOT
+    rows = {}
+    try:
+        rms.USE_SNAPSHOT = False
+        for chunksize in chunksizes:
+            seconds, peak = peak_memory(lambda: _cold_stores_data(chunksize))
+            rows[chunksize or "in memory"] = {"seconds": seconds, "peak MB": peak}
+    finally:
+        rms.USE_SNAPSHOT = use_snapshot
+        rms.invalidate_cache()
+    return pd.DataFrame(rows).T
+
+
+def bench_memory(repeat=1):
+    """Memory per column of the merged frame compared to the compact representation."""
+    report = rms.memory_report(merged=rms.get_data_df(), compact=rms.get_data_df(compact=True), store=rms.get_store_df())
+    report.loc["saved (%)", "merged"] = 100 * (1 - report.loc["total", ["compact", "store"]].sum() / report.loc["total", "merged"])
+    return report.fillna(0).round(2)
+
+
+def make_synthetic_data(directory, n_stores=1115, n_days=942, seed=0):
+    """Write a deterministic, Rossmann shaped train.csv and store.csv to directory.
+
+    Keyword arguments:
+    directory -- where to write the csv files
+    n_stores -- number of stores
+    n_days -- number of days, ending on 2015-07-31 like the original data
+    seed -- seed of the random generator, same seed gives the same files
+    """
+    rng = np.random.default_rng(seed)
+    stores = np.arange(1, n_stores + 1)
+
+    promo2 = rng.random(n_stores) < 0.5
+    competition_known = rng.random(n_stores) < 0.7
+    store = pd.DataFrame({
+        "Store": stores,
+        "StoreType": rng.choice(list("abcd"), n_stores, p=[0.54, 0.02, 0.13, 0.31]),
+        "Assortment": rng.choice(list("abc"), n_stores, p=[0.53, 0.01, 0.46]),
+        "CompetitionDistance": pd.array(rng.integers(20, 20_000, n_stores), dtype="Int32"),
+        "CompetitionOpenSinceMonth": pd.array(np.where(competition_known, rng.integers(1, 13, n_stores), -1), dtype="Int32"),
+        "CompetitionOpenSinceYear": pd.array(np.where(competition_known, rng.integers(2005, 2016, n_stores), -1), dtype="Int32"),
+        "Promo2": promo2.astype(int),
+        "Promo2SinceWeek": pd.array(np.where(promo2, rng.integers(1, 53, n_stores), -1), dtype="Int32"),
+        "Promo2SinceYear": pd.array(np.where(promo2, rng.integers(2009, 2016, n_stores), -1), dtype="Int32"),
+        "PromoInterval": np.where(promo2, rng.choice(["Jan,Apr,Jul,Oct", "Feb,May,Aug,Nov", "Mar,Jun,Sept,Dec"], n_stores), ""),
+    })
+    for col in ["CompetitionOpenSinceMonth", "CompetitionOpenSinceYear", "Promo2SinceWeek", "Promo2SinceYear"]:
+        store.loc[store[col] == -1, col] = pd.NA
+    store.to_csv(os.path.join(directory, "store.csv"), index=False)
+
+    # neuste Tage zuerst, wie in train.csv
+    dates = pd.date_range(end="2015-07-31", periods=n_days)[::-1]
+    store_ids = np.tile(stores, n_days)
+    date = np.repeat(dates, n_stores)
+    n = len(date)
+
+    day_of_week = date.dayofweek + 1
+    state_holiday = np.where(rng.random(n) < 0.03, rng.choice(list("abc"), n), "0")
+    is_open = (day_of_week != 7) & (rng.random(n) > 0.02) & (state_holiday == "0")
+    promo = ((date.day // 7) % 2 == 0) & (day_of_week < 6)
+    level = rng.lognormal(8.7, 0.35, n_stores)[store_ids - 1]
+    sales = (level * rng.normal(1, 0.2, n).clip(0.1) * (1 + 0.2 * promo) * is_open).astype(int)
+    customers = (sales / rng.normal(9, 1, n).clip(5)).astype(int)
+
+    train = pd.DataFrame({"Store": store_ids, "DayOfWeek": day_of_week, "Date": date.strftime("%Y-%m-%d"),
+                          "Sales": sales, "Customers": customers, "Open": is_open.astype(int), "Promo": promo.astype(int),
+                          "StateHoliday": state_holiday, "SchoolHoliday": (rng.random(n) < 0.18).astype(int)})
+
+    # ein Teil der Filialen ist im zweiten Halbjahr 2014 wegen Renovierung geschlossen
+    renovated = rng.random(n_stores + 1) < 0.16
+    renovation = renovated[train.Store] & (date >= "2014-07-01") & (date <= "2014-12-31")
+    train.loc[~renovation].to_csv(os.path.join(directory, "train.csv"), index=False)
+
+
+def _import_pms():
+    """Import pms with fig.show() turned into a no-op, figures are built but never displayed."""
+    from plotly.basedatatypes import BaseFigure
+    BaseFigure.show = lambda self, *args, **kwargs: None
+    import pms
+    return pms
+
+
+def _suite_cases():
+    """The paths the suite measures as name -> (setup, func); setup is untimed, func is measured.
+
+    pms is only imported by the setup of the report cases, the loader cases run without plotly.
+    """
+    def load():
+        rms.get_train_df()
+        rms.get_store_df()
+
+    def load_pms():
+        load()
+        rms.get_data_open_df(compact=True)
+        _import_pms()
+
+    def load_store_pms():
+        load_pms()
+        rms.get_store_data_df(1)
+
+    def store_open():
+        data = rms.get_store_data_df(1)
+        return data.loc[data.Open==1]
+
+    return {
+        "get_train_df": (None, rms.get_train_df),
+        "get_store_df": (None, rms.get_store_df),
+        "get_data_df": (load, rms.get_data_df),
+        "get_data_open_df": (load, rms.get_data_open_df),
+        "get_store_data_df": (load, lambda: rms.get_store_data_df(1)),
+        "get_impact_df": (rms.get_data_open_df, lambda: [rms.get_impact_df(rms.get_data_open_df(), t) for t in ["competition", "promo2"]]),
+        "get_stores_data_df": (load, rms.get_stores_data_df),
+        "get_competition_and_promo2": (load, lambda: rms.get_competition_and_promo2(1)),
+        "get_weekly_data": (load, lambda: rms.get_weekly_data(1)),
+        "get_weekly_prediction_df": (load, lambda: rms.get_weekly_prediction_df(1)),
+        "get_weekly_prediction_dfs": (load, rms.get_weekly_prediction_dfs),
+        "print_store_info": (load_pms, lambda: _import_pms().print_store_info(1)),
+        "keep_rolling": (load_store_pms, lambda: _import_pms().keep_rolling(store_open(), "Sales", [7, 28], show=False)),
+        "plotly_boxes": (load_store_pms, lambda: _import_pms().plotly_boxes(store_open(), "Promo", show=False)),
+        "plot_impact": (load_pms, lambda: _import_pms().plot_impact("daily_mean_sales_diff", "competition")),
+        "plot_shared_x": (load_pms, lambda: _import_pms().plot_shared_x("Sales", "Customers")),
+    }
+
+
+SUITE_CASES = ["get_train_df", "get_store_df", "get_data_df", "get_data_open_df", "get_store_data_df", "get_impact_df",
+               "get_stores_data_df", "get_competition_and_promo2", "get_weekly_data", "get_weekly_prediction_df",
+               "get_weekly_prediction_dfs", "print_store_info", "keep_rolling", "plotly_boxes", "plot_impact", "plot_shared_x"]
+
+
+def _rss_mb(field="VmHWM"):
+    """Peak (VmHWM) or current (VmRSS) resident set size of this process in MB.
+
+    Read from /proc on Linux, elsewhere falls back to ru_maxrss.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS to the current RSS (Linux only, no-op elsewhere)."""
+    with contextlib.suppress(OSError):
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+
+def _run_suite_case(name, directory):
+    """Measure one suite case in a fresh process and return its wall time and peak RSS.
+
+    Figures are built but not shown, output of the report functions is discarded.
+    """
+    rms.TRAIN_CSV, rms.STORE_CSV = os.path.join(directory, "train.csv"), os.path.join(directory, "store.csv")
+    rms.SNAPSHOT_DIR = os.path.join(directory, "snapshot")
+    rms.USE_SNAPSHOT = False
+
+    setup, func = _suite_cases()[name]
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        if setup is not None:
+            setup()
+        _reset_peak_rss()
+        rss_before = _rss_mb("VmRSS")
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    peak = _rss_mb()
+    return {"seconds": seconds, "peak_rss_mb": peak, "rss_delta_mb": peak - rss_before}
+
+
+def run_suite(n_stores=1115, n_days=942, repeat=1, cases=None):
+    """Run the benchmark suite on synthetic data and return the results per case.
+
+    Every case runs repeat times, each in a fresh process so that neither the rms cache nor the
+    peak RSS of an earlier case leaks into the measurement. The best run is kept.
+
+    Keyword arguments:
+    n_stores -- number of synthetic stores
+    n_days -- number of synthetic days
+    repeat -- runs per case
+    cases -- names of the cases to run, default is all of SUITE_CASES
+    """
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        make_synthetic_data(directory, n_stores, n_days)
+        for name in cases or SUITE_CASES:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as pool:
+                    runs.append(pool.submit(_run_suite_case, name, directory).result())
+            results[name] = {key: min(run[key] for run in runs) for key in runs[0]}
+    finally:
+        shutil.rmtree(directory)
+    return {"stores": n_stores, "days": n_days, "results": results}
+
+
+def compare_to_baseline(suite, baseline, threshold=0.2, min_seconds=0.05, min_rss_mb=10):
+    """Compare suite results with a baseline and return a frame with one row per case.
+
+    A case regresses if its time or peak RSS grows by more than threshold (relative) and
+    also by more than min_seconds / min_rss_mb (absolute), to not fail on noise.
+    """
+    if (suite["stores"], suite["days"]) != (baseline["stores"], baseline["days"]):
+        raise ValueError(f"baseline was measured on {baseline['stores']} stores x {baseline['days']} days, "
+                         f"not {suite['stores']} x {suite['days']}")
+
+    rows = {}
+    for name, result in suite["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        slower = (result["seconds"] > base["seconds"] * (1 + threshold)) & (result["seconds"] - base["seconds"] > min_seconds)
+        bigger = (result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + threshold)) & (result["peak_rss_mb"] - base["peak_rss_mb"] > min_rss_mb)
+        rows[name] = {"seconds": result["seconds"], "baseline seconds": base["seconds"],
+                      "peak_rss_mb": result["peak_rss_mb"], "baseline peak_rss_mb": base["peak_rss_mb"],
+                      "regression": bool(slower or bigger)}
+    return pd.DataFrame(rows).T
+
+
+def bench_global_forecast(repeat=1, n_stores=100, models=("LinearRegression", "GradientBoosting")):
+    """Compare one global model for all stores with a per-store loop: fit+predict time and mean test scores."""
+    import warnings
+
+    import forecast
+
+    stores = rms.get_store_df().index[:n_stores]
+    weekly = rms.get_weekly_prediction_dfs(list(stores))
+    rows = {}
+    for model_name in models:
+        start = time.perf_counter()
+        scores = []
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for store in stores:
+                _, _, store_scores = forecast.fit_and_score(model_name, *forecast.prepare_store_data(weekly.loc[store]))
+                scores.append(store_scores)
+        rows[f"per store: {model_name}"] = dict(pd.DataFrame(scores)[["mae", "mape", "rmse", "r2"]].mean(),
+                                                seconds=time.perf_counter() - start)
+
+    start = time.perf_counter()
+    _, _, scores = forecast.fit_and_score_global(*forecast.prepare_global_data(weekly))
+    rows["global: HistGradientBoosting"] = dict(scores.mean(), seconds=time.perf_counter() - start)
+    return pd.DataFrame(rows).T
+
+
+def _metrics_per_store(df, windows):
+    """get_metrics and one rolling mean per window, store by store, as the reports do it."""
+    results = []
+    for _, store_df in df.groupby(level="Store"):
+        store_df = rms.get_metrics(store_df[["Sales", "Customers"]].copy())
+        for window in windows:
+            store_df[f"Sales_ma{window}"] = store_df.Sales.rolling(window=window, center=True).mean()
+        results.append(store_df)
+    return pd.concat(results)
+
+
+def bench_metrics(repeat=3, windows=(7, 28, 91)):
+    """Compare rms.compute_metrics for all stores with get_metrics and per-window rolling calls per store."""
+    data_df = rms.get_data_df(compact=True)
+    columns = rms.METRIC_COLUMNS + [f"Sales_ma{window}" for window in windows]
+
+    expected = _metrics_per_store(data_df, windows)[columns]
+    computed = rms.compute_metrics(data_df, windows=windows)
+    pd.testing.assert_frame_equal(computed, expected, check_dtype=False)
+
+    results = {
+        "per store (get_metrics + rolling)": timeit(lambda: _metrics_per_store(data_df, windows), 1),
+        "compute_metrics (all stores)": timeit(lambda: rms.compute_metrics(data_df, windows=windows), repeat),
+    }
+    return pd.Series(results, name="seconds").to_frame()
+
+
+def _cross_validate_naive(X, y, candidates, n_splits=5):
+    """Every candidate on every fold, scaling the fold again for each candidate, no early stopping."""
+    from sklearn.metrics import mean_absolute_error
+    from sklearn.model_selection import TimeSeriesSplit
+    from sklearn.preprocessing import StandardScaler
+
+    import forecast
+
+    X = np.asarray(X, dtype="float64")
+    maes = {}
+    for name, factory in candidates.items():
+        fold_maes = []
+        for train, test in TimeSeriesSplit(n_splits=n_splits, test_size=forecast.TEST_WEEKS).split(X):
+            scaler = StandardScaler().fit(X[train])
+            try:
+                model = factory().fit(scaler.transform(X[train]), y.iloc[train])
+                fold_maes.append(mean_absolute_error(y.iloc[test], model.predict(scaler.transform(X[test]))))
+            except Exception:
+                fold_maes.append(np.inf)
+        maes[name] = np.mean(fold_maes)
+    return pd.Series(maes).sort_values()
+
+
+def bench_cv(repeat=1, n_stores=5, n_jobs=1):
+    """Per-store model selection by time-series CV: every candidate on every fold vs forecast.cross_validate."""
+    import warnings
+
+    import forecast
+
+    stores = rms.get_store_df().index[:n_stores]
+    weekly = rms.get_weekly_prediction_dfs(list(stores))
+    rows = []
+    for store in stores:
+        X_train, _, y_train, _ = forecast.split_store_data(weekly.loc[store])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            naive = _cross_validate_naive(X_train, y_train, forecast.CV_CANDIDATES)
+            naive_seconds = timeit(lambda: _cross_validate_naive(X_train, y_train, forecast.CV_CANDIDATES), repeat)
+            engine = forecast.cross_validate(forecast.FoldCache(X_train, y_train), n_jobs=n_jobs)
+            engine_seconds = timeit(lambda: forecast.cross_validate(forecast.FoldCache(X_train, y_train), n_jobs=n_jobs), repeat)
+        rows.append({"store": store, "naive_s": naive_seconds, "engine_s": engine_seconds,
+                     "naive_best": naive.index[0], "engine_best": engine.index[0],
+                     "abandoned": int(engine.abandoned.sum())})
+    return pd.DataFrame(rows).set_index("store")
+
+
+STARTUP_CASES = {
+    "python": "pass",
+    "import rms": "import rms",
+    "import pms (data only)": "import pms",
+    "import pms + first figure": "import pms; pms.go.Figure(pms.go.Scatter(y=[1, 2, 3]))",
+}
+
+_STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+seconds = time.perf_counter() - start
+with open("/proc/self/status") as f:
+    rss_kb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+print(json.dumps({"seconds": seconds, "peak_rss_mb": rss_kb / 1024, "plotly": "plotly" in sys.modules}))
+"""
+
+
+def bench_startup(repeat=3):
+    """Import time and peak RSS of a fresh interpreter for data-only and plotting use of rms/pms."""
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    rows = {}
+    for name, statement in STARTUP_CASES.items():
+        runs = [json.loads(subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, statement], cwd=here,
+                                          capture_output=True, text=True, check=True).stdout)
+                for _ in range(repeat)]
+        rows[name] = {"seconds": min(run["seconds"] for run in runs),
+                      "peak_rss_mb": min(run["peak_rss_mb"] for run in runs), "plotly": runs[0]["plotly"]}
+    return pd.DataFrame(rows).T
+
+
+BENCHMARKS = {
+    "snapshot": bench_snapshot,
+    "single_store": bench_single_store,
+    "impact": bench_impact,
+    "append": bench_append,
+    "streaming": bench_streaming,
+    "memory": bench_memory,
+    "global_forecast": bench_global_forecast,
+    "metrics": bench_metrics,
+    "cv": bench_cv,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=list(BENCHMARKS) + ["suite"])
+    parser.add_argument("--repeat", type=int, default=3)
+    suite_args = parser.add_argument_group("suite")
+    suite_args.add_argument("--stores", type=int, default=1115)
+    suite_args.add_argument("--days", type=int, default=942)
+    suite_args.add_argument("--cases", nargs="+", choices=SUITE_CASES)
+    suite_args.add_argument("--baseline", help="baseline json to compare against, exits with 1 on a regression")
+    suite_args.add_argument("--save-baseline", help="write the results as new baseline json")
+    suite_args.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown, default 0.2")
+    args = parser.parse_args()
+
+    if args.benchmark != "suite":
+        print(BENCHMARKS[args.benchmark](repeat=args.repeat))
+        sys.exit()
+
+    suite = run_suite(args.stores, args.days, args.repeat, args.cases)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(suite, f, indent=2)
+
+    if not args.baseline:
+        print(pd.DataFrame(suite["results"]).T.to_string())
+        sys.exit()
+
+    with open(args.baseline) as f:
+        report = compare_to_baseline(suite, json.load(f), args.threshold)
+    print(report.to_string())
+    sys.exit(int(report.regression.any()))
@@ -0,0 +1,473 @@
+"""Weekly sales forecasts for Rossmann stores."""
+import argparse
+import functools
+import os
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from sklearn.dummy import DummyRegressor
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+from sklearn.linear_model import Lasso, LassoCV, LinearRegression, Ridge, RidgeCV
+from sklearn.metrics import mean_absolute_error, mean_absolute_percentage_error, mean_squared_error, r2_score
+from sklearn.model_selection import TimeSeriesSplit
+from sklearn.preprocessing import StandardScaler
+
+import rms
+
+
+TEST_WEEKS = 8
+CHECKPOINT_DIR = "model_selection"
+RESULTS_COLUMNS = ["store", "model", "mae", "mape", "rmse", "r2", "seconds", "error"]
+
+
+def get_scores(y_true, y_pred):
+    """Return MAE, MAPE, RMSE and R2 of a prediction as dict."""
+    return {"mae": mean_absolute_error(y_true, y_pred),
+            "mape": mean_absolute_percentage_error(y_true, y_pred),
+            "rmse": np.sqrt(mean_squared_error(y_true, y_pred)),
+            "r2": r2_score(y_true, y_pred)}
+
+
+def get_date_stuff(data):
+    """Add Week, Month, Quarter and Year of the (weekly) date index as columns."""
+    data = data.copy()
+    data["Week"] = data.index.isocalendar().week
+    data["Month"] = data.index.month
+    data["Quarter"] = data.index.quarter
+    data["Year"] = data.index.year
+    return data
+
+
+def prepare_x_and_y(data):
+    """Prepare X and y to be used by ML models."""
+    X = data.drop("Sales".split(), axis=1)
+    y = data.Sales
+
+    if "Competition" in data.columns:
+        X = X.drop(["CompetitionSince", "CompetitionDistance"], axis=1)
+    if "Promo2" in data.columns:
+        X = X.drop(["Promo2Since", "PromoInterval"], axis=1)
+
+    return X, y
+
+
+def my_train_test_split(X, y, testsize=TEST_WEEKS):
+    """ Split X and y into trainings and test sets.
+    
+    Use 8 weeks as default test size."""
+    X_train = X.iloc[:-testsize,:]
+    X_test = X.iloc[-testsize:, :]
+    y_train = y.iloc[:-testsize]
+    y_test = y.iloc[-testsize:]
+
+    return X_train, X_test, y_train, y_test
+
+
+def split_store_data(weekly_data):
+    """Turn the weekly prediction data of one store into unscaled train and test sets.
+
+    Keyword arguments:
+    weekly_data -- the result of rms.get_weekly_prediction_df for one store
+    """
+    # im Sammel-Frame haben nicht betroffene Filialen leere Competition/Promo2 Spalten
+    weekly_data = weekly_data.dropna(axis=1, how="all")
+    weekly_data = weekly_data.loc[weekly_data.Sales>0]
+    weekly_data = get_date_stuff(weekly_data)
+
+    X, y = prepare_x_and_y(weekly_data)
+    return my_train_test_split(X, y)
+
+
+def prepare_store_data(weekly_data):
+    """Turn the weekly prediction data of one store into scaled train and test sets.
+
+    Keyword arguments:
+    weekly_data -- the result of rms.get_weekly_prediction_df for one store
+    """
+    X_train, X_test, y_train, y_test = split_store_data(weekly_data)
+
+    scaler = StandardScaler()
+    X_train_scaled = pd.DataFrame(scaler.fit_transform(X_train), index=X_train.index, columns=X_train.columns)
+    X_test_scaled = pd.DataFrame(scaler.transform(X_test), index=X_test.index, columns=X_test.columns)
+
+    return X_train_scaled, X_test_scaled, y_train, y_test
+
+
+def _lasso():
+    return LassoCV(cv=TimeSeriesSplit(test_size=TEST_WEEKS))
+
+
+def _ridge():
+    return RidgeCV(alphas=[0.001, 0.01, 0.1, 0.5, 1, 5, 10], cv=TimeSeriesSplit(test_size=TEST_WEEKS))
+
+
+def _random_forest():
+    return RandomForestRegressor(n_estimators=1000, random_state=420)
+
+
+class ArimaForecaster:
+    """ARIMA on the sales history only, with the fit/predict interface of the sklearn models."""
+
+    def __init__(self, order=(5, 1, 2)):
+        self.order = order
+
+    def fit(self, X, y):
+        from statsmodels.tsa.arima.model import ARIMA
+
+        y = y.copy()
+        y.index = pd.DatetimeIndex(y.index.values, freq=y.index.inferred_freq)
+        self.model_ = ARIMA(y, order=self.order).fit()
+        return self
+
+    def predict(self, X):
+        return np.asarray(self.model_.forecast(len(X)))
+
+
+# Kandidaten wie im Notebook rossman_sales_weekly_prediction_vscode.ipynb
+MODELS = {
+    "DummyRegressor": DummyRegressor,
+    "LinearRegression": LinearRegression,
+    "Lasso": _lasso,
+    "Ridge": _ridge,
+    "RandomForest": _random_forest,
+    "GradientBoosting": GradientBoostingRegressor,
+    "ARIMA": ArimaForecaster,
+}
+
+
+# Kandidaten für cross_validate: die Modelle aus MODELS, Lasso und Ridge mit festem alpha statt eigener CV
+LASSO_ALPHAS = [1, 3, 10, 30, 100, 300, 1000, 3000]
+RIDGE_ALPHAS = [0.001, 0.01, 0.1, 0.5, 1, 5, 10]
+CV_CANDIDATES = {
+    "DummyRegressor": DummyRegressor,
+    "LinearRegression": LinearRegression,
+    **{f"Lasso(alpha={alpha})": functools.partial(Lasso, alpha=alpha, max_iter=10_000) for alpha in LASSO_ALPHAS},
+    **{f"Ridge(alpha={alpha})": functools.partial(Ridge, alpha=alpha) for alpha in RIDGE_ALPHAS},
+    "RandomForest": _random_forest,
+    "GradientBoosting": GradientBoostingRegressor,
+    "ARIMA": ArimaForecaster,
+}
+
+
+class FoldCache:
+    """The TimeSeriesSplit folds of one store's training data, scaled once and shared by all candidates.
+
+    Keyword arguments:
+    X -- the unscaled training features
+    y -- the training target
+    n_splits -- number of folds
+    test_size -- weeks per validation fold
+    """
+
+    def __init__(self, X, y, n_splits=5, test_size=TEST_WEEKS):
+        X = np.asarray(X, dtype="float64")
+        self.folds = []
+        for train, test in TimeSeriesSplit(n_splits=n_splits, test_size=test_size).split(X):
+            scaler = StandardScaler().fit(X[train])
+            self.folds.append((scaler.transform(X[train]), scaler.transform(X[test]), y.iloc[train], y.iloc[test]))
+
+    def __len__(self):
+        return len(self.folds)
+
+
+def _score_fold(factory, fold):
+    X_train, X_test, y_train, y_test = fold
+    start = time.perf_counter()
+    try:
+        y_pred = factory().fit(X_train, y_train).predict(X_test)
+        mae = mean_absolute_error(y_test, y_pred)
+    except Exception:
+        # z.B. ARIMA ohne erkennbare Frequenz, wenn Wochen ohne Umsatz fehlen
+        mae = np.inf
+    return mae, time.perf_counter() - start
+
+
+def cross_validate(folds, candidates=None, n_jobs=1, tolerance=0.15, min_folds=2):
+    """Validate candidate models on shared folds, dropping clear losers early.
+
+    Folds are evaluated in rounds of n_jobs folds (in threads), after every round candidates whose
+    mean MAE so far exceeds the best one by more than tolerance are abandoned, once min_folds
+    folds are done. A candidate failing on a fold gets an infinite MAE. Returns one row per candidate, sorted by MAE, fully validated ones first.
+
+    Keyword arguments:
+    folds -- a FoldCache
+    candidates -- dict of name -> model factory, default is CV_CANDIDATES
+    n_jobs -- folds evaluated in parallel
+    tolerance -- relative MAE margin to the best candidate before one is abandoned
+    min_folds -- folds every candidate is validated on before abandoning
+    """
+    candidates = CV_CANDIDATES if candidates is None else candidates
+    maes = {name: [] for name in candidates}
+    seconds = dict.fromkeys(candidates, 0.0)
+    active = list(candidates)
+    round_size = max(n_jobs, 1)
+
+    # catch_warnings ist nicht thread-safe, der Filter wird einmal hier für alle Worker-Threads gesetzt;
+    # record=True fängt auch, was der erste statsmodels-Import per "always"-Filter wieder freischaltet
+    with warnings.catch_warnings(record=True), ThreadPoolExecutor(max_workers=round_size) as pool:
+        warnings.simplefilter("ignore")
+        for first in range(0, len(folds), round_size):
+            tasks = [(name, fold) for name in active for fold in folds.folds[first:first + round_size]]
+            for (name, _), (mae, fit_seconds) in zip(tasks, pool.map(lambda task: _score_fold(candidates[task[0]], task[1]), tasks)):
+                maes[name].append(mae)
+                seconds[name] += fit_seconds
+
+            done = first + round_size
+            if done >= min_folds and done < len(folds):
+                means = {name: np.mean(maes[name]) for name in active}
+                best = min(means.values())
+                active = [name for name in active if means[name] <= best * (1 + tolerance)]
+
+    results = pd.DataFrame({"mae": {name: np.mean(values) for name, values in maes.items()},
+                            "folds": {name: len(values) for name, values in maes.items()},
+                            "seconds": seconds})
+    results["abandoned"] = results.folds < len(folds)
+    return results.sort_values(["abandoned", "mae"])
+
+
+def select_model_cv(weekly_data, candidates=None, n_splits=5, n_jobs=1, tolerance=0.15):
+    """Pick the best candidate of one store by time-series CV, refit it on all training weeks and score it on the test weeks.
+
+    Returns the name of the best candidate, the CV results and the test scores incl. the wall time.
+
+    Keyword arguments:
+    weekly_data -- the weekly prediction data of one store
+    candidates -- dict of name -> model factory, default is CV_CANDIDATES
+    n_splits -- number of CV folds
+    n_jobs -- folds evaluated in parallel
+    tolerance -- see cross_validate
+    """
+    start = time.perf_counter()
+    candidates = CV_CANDIDATES if candidates is None else candidates
+    X_train, X_test, y_train, y_test = split_store_data(weekly_data)
+
+    cv = cross_validate(FoldCache(X_train, y_train, n_splits), candidates, n_jobs, tolerance)
+    best = cv.index[0]
+
+    scaler = StandardScaler().fit(X_train)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = candidates[best]().fit(scaler.transform(X_train), y_train)
+        y_pred = pd.Series(model.predict(scaler.transform(X_test)), y_test.index)
+
+    scores = get_scores(y_test, y_pred)
+    scores["seconds"] = time.perf_counter() - start
+    return best, cv, scores
+
+
+def fit_and_score(model_name, X_train, X_test, y_train, y_test):
+    """Fit one candidate model and score it on the test weeks.
+
+    Returns the fitted model, the prediction and the scores incl. the wall time in seconds.
+    """
+    start = time.perf_counter()
+    model = MODELS[model_name]()
+    model.fit(X_train, y_train)
+    y_pred = pd.Series(model.predict(X_test), y_test.index)
+
+    scores = get_scores(y_test, y_pred)
+    scores["seconds"] = time.perf_counter() - start
+    return model, y_pred, scores
+
+
+def get_scores_by_store(y_true, y_pred):
+    """MAE, MAPE, RMSE and R2 per store of a (Store, Date) indexed prediction, one row per store."""
+    errors = pd.DataFrame({"y": y_true, "error": y_pred - y_true})
+    errors["abs"] = errors.error.abs()
+    errors["pct"] = errors["abs"] / errors.y.abs()
+    errors["sq"] = errors.error**2
+    errors["dev"] = (errors.y - errors.y.groupby(level="Store").transform("mean"))**2
+
+    grouped = errors.groupby(level="Store")
+    scores = pd.DataFrame({"mae": grouped["abs"].mean(), "mape": grouped.pct.mean(),
+                           "rmse": np.sqrt(grouped.sq.mean()), "r2": 1 - grouped.sq.sum() / grouped.dev.sum()})
+    scores.index.name = "store"
+    return scores
+
+
+def prepare_global_data(weekly=None, testsize=TEST_WEEKS):
+    """Turn the weekly prediction data of many stores into one feature matrix with store attributes.
+
+    The last testsize weeks (with sales) of every store are the test set, like my_train_test_split
+    per store. Besides the weekly columns and the date parts, the store.csv attributes and the mean
+    weekly sales of the store's training weeks are features, so one model can serve all stores.
+
+    Keyword arguments:
+    weekly -- the result of rms.get_weekly_prediction_dfs, default is all stores
+    testsize -- number of test weeks per store
+    """
+    weekly = rms.get_weekly_prediction_dfs() if weekly is None else weekly
+    weekly = weekly.loc[weekly.Sales>0]
+
+    # nicht betroffene Filialen haben keine Competition/Promo2
+    data = weekly.drop(["CompetitionSince", "CompetitionDistance", "Promo2Since", "PromoInterval"], axis=1)
+    data = data.fillna({"Competition": 0, "Promo2": 0})
+
+    dates = data.index.get_level_values("Date")
+    data["Week"] = dates.isocalendar().week.astype("int32").to_numpy()
+    data["Month"] = dates.month
+    data["Quarter"] = dates.quarter
+    data["Year"] = dates.year
+
+    store_df = rms.get_store_df()
+    attrs = store_df[["StoreType", "Assortment", "CompetitionDistance", "PromoInterval"]]
+    attrs = attrs.astype({"CompetitionDistance": "float64"}).reindex(data.index.get_level_values("Store"))
+    attrs.columns = ["StoreType", "Assortment", "StoreCompetitionDistance", "StorePromoInterval"]
+    attrs.index = data.index
+    data = data.join(attrs)
+
+    is_test = data.groupby(level="Store").cumcount(ascending=False) < testsize
+    store_mean = data.Sales.loc[~is_test].groupby(level="Store").mean()
+    data["StoreMeanSales"] = store_mean.reindex(data.index.get_level_values("Store")).to_numpy()
+
+    X = data.drop("Sales", axis=1)
+    y = data.Sales.astype("float64")
+    return X.loc[~is_test], X.loc[is_test], y.loc[~is_test], y.loc[is_test]
+
+
+def _hist_gradient_boosting():
+    return HistGradientBoostingRegressor(max_iter=500, learning_rate=0.05, categorical_features="from_dtype", random_state=420)
+
+
+def fit_and_score_global(X_train, X_test, y_train, y_test):
+    """Fit one model on all stores and forecast the test weeks of every store in one predict call.
+
+    Returns the fitted model, the prediction and the scores per store, the wall time of fit
+    and predict is stored as seconds in the scores' attrs.
+    """
+    start = time.perf_counter()
+    model = _hist_gradient_boosting()
+    model.fit(X_train, y_train)
+    y_pred = pd.Series(model.predict(X_test), y_test.index)
+
+    scores = get_scores_by_store(y_test, y_pred)
+    scores.attrs["seconds"] = time.perf_counter() - start
+    return model, y_pred, scores
+
+
+_weekly_path = None
+
+
+def _init_worker(weekly_path):
+    global _weekly_path
+    _weekly_path = weekly_path
+    # mit n_jobs=1 läuft das im Hauptprozess, ein früherer Lauf kann anderen Pfad oder ältere Daten haben
+    _load_store_data.cache_clear()
+
+
+@functools.lru_cache(maxsize=8)
+def _load_store_data(store):
+    """Read one store from the shared weekly frame and prepare it, cached per worker."""
+    return prepare_store_data(rms.load_frame(_weekly_path, store_id=store).loc[store])
+
+
+def _run_task(store, model_name):
+    """Fit and score one model for one store. Errors are reported, not raised."""
+    row = {"store": store, "model": model_name}
+    try:
+        with warnings.catch_warnings():
+            # ARIMA und LassoCV warnen bei kurzen Reihen ausgiebig
+            warnings.simplefilter("ignore")
+            _, _, scores = fit_and_score(model_name, *_load_store_data(store))
+        row.update(scores)
+    except Exception:
+        row["error"] = traceback.format_exc(limit=1).strip().splitlines()[-1]
+    return row
+
+
+def select_models(ids=None, models=None, n_jobs=None, checkpoint_dir=CHECKPOINT_DIR):
+    """Fit and score all candidate models for many stores on a process pool.
+
+    The weekly data of all stores is built once and saved to checkpoint_dir, workers
+    memory-map only the rows of their store. Every finished (store, model) is appended
+    to checkpoint_dir/results.csv, so an interrupted run resumes where it stopped.
+    A change of train.csv starts from scratch.
+
+    Keyword arguments:
+    ids -- list of store ids, default is all stores
+    models -- list of model names from MODELS, default is all
+    n_jobs -- number of worker processes, default is the number of CPUs, 1 runs in-process
+    checkpoint_dir -- directory for the shared data and the results
+    """
+    models = list(models or MODELS)
+    weekly_path = os.path.join(checkpoint_dir, "weekly")
+    results_path = os.path.join(checkpoint_dir, "results.csv")
+
+    if rms.load_frame(weekly_path) is None:
+        rms.save_frame(rms.get_weekly_prediction_dfs(), weekly_path)
+        if os.path.exists(results_path):
+            os.remove(results_path)
+
+    if not os.path.exists(results_path):
+        pd.DataFrame(columns=RESULTS_COLUMNS).to_csv(results_path, index=False)
+    done = pd.read_csv(results_path)
+    done = set(zip(done.store, done.model))
+
+    stores = rms.get_store_df().index if ids is None else ids
+    tasks = [(int(store), model) for store in stores for model in models if (store, model) not in done]
+
+    with open(results_path, "a") as f:
+        def checkpoint(row):
+            pd.DataFrame([row], columns=RESULTS_COLUMNS).to_csv(f, header=False, index=False)
+            f.flush()
+
+        if n_jobs == 1:
+            _init_worker(weekly_path)
+            for task in tasks:
+                checkpoint(_run_task(*task))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(weekly_path,)) as pool:
+                futures = [pool.submit(_run_task, *task) for task in tasks]
+                for future in as_completed(futures):
+                    checkpoint(future.result())
+
+    results = pd.read_csv(results_path)
+    results = results.loc[results.store.isin(stores) & results.model.isin(models)]
+    return results.sort_values(["store", "model"]).reset_index(drop=True)
+
+
+def get_best_models(results, metric="mae"):
+    """Pick the best model per store from the results of select_models."""
+    ascending = metric != "r2"
+    results = results.dropna(subset=[metric]).sort_values(metric, ascending=ascending)
+    return results.groupby("store").head(1).set_index("store").sort_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    select = subparsers.add_parser("select", help="select the best model per store")
+    select.add_argument("--stores", type=int, nargs="+")
+    select.add_argument("--models", nargs="+", choices=list(MODELS))
+    select.add_argument("--jobs", type=int)
+    select.add_argument("--metric", default="mae", choices=["mae", "mape", "rmse", "r2"])
+    select.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+    global_model = subparsers.add_parser("global", help="fit one model for all stores and score its forecasts")
+    global_model.add_argument("--stores", type=int, nargs="+")
+    cv = subparsers.add_parser("cv", help="select the model of some stores by time-series cross validation")
+    cv.add_argument("stores", type=int, nargs="+")
+    cv.add_argument("--jobs", type=int, default=1, help="folds validated in parallel")
+    cv.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    if args.command == "cv":
+        weekly = rms.get_weekly_prediction_dfs(args.stores)
+        for store in args.stores:
+            best, cv_results, scores = select_model_cv(weekly.loc[store], n_jobs=args.jobs, tolerance=args.tolerance)
+            print(f"store {store}: {best}, test mae {scores['mae']:.0f}, {scores['seconds']:.1f}s")
+            print(cv_results)
+
+    if args.command == "global":
+        weekly = rms.get_weekly_prediction_dfs(args.stores)
+        _, _, scores = fit_and_score_global(*prepare_global_data(weekly))
+        print(scores.describe())
+        print(f"fit and predict: {scores.attrs['seconds']:.2f}s")
+
+    if args.command == "select":
+        results = select_models(args.stores, args.models, args.jobs, args.checkpoint_dir)
+        print(get_best_models(results, args.metric))
@@ -0,0 +1,196 @@
+"""Opt-in timing instrumentation for rms and pms.
+
+Switched off by default, a decorated function then only pays one flag check per call.
+Switch it on with the environment variable RMS_PROFILE=1 (before the import) or enable(),
+e.g.
+
+    RMS_PROFILE=1 RMS_PROFILE_TRACE=trace.json python -c "import pms; pms.print_store_info(1)"
+
+and open trace.json in chrome://tracing or https://ui.perfetto.dev. summary() shows
+call counts, cumulative / self / per-call latency, rows in and out and RSS deltas.
+"""
+import atexit
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("RMS_PROFILE", "") not in ("", "0")
+
+_stats = {}
+_events = []
+_local = threading.local()
+_lock = threading.Lock()
+_epoch = time.perf_counter()
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError):
+    _PAGE_SIZE = 0
+
+
+def enable():
+    """Start recording."""
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    """Stop recording, recorded stats are kept."""
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    """Drop all recorded stats and trace events."""
+    with _lock:
+        _stats.clear()
+        _events.clear()
+
+
+def _rss():
+    """Current resident set size in bytes, 0 where /proc isn't available."""
+    if not _PAGE_SIZE:
+        return 0
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return 0
+
+
+def _rows(obj):
+    """Number of rows of a frame or series, None for anything else."""
+    return len(obj) if hasattr(obj, "shape") and hasattr(obj, "__len__") else None
+
+
+def _record(name, start, seconds, child_seconds, rows_in, rows_out, rss_delta):
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = {"calls": 0, "total_s": 0.0, "self_s": 0.0, "min_s": float("inf"), "max_s": 0.0,
+                                   "rows_in": 0, "rows_out": 0, "rss_delta_mb": 0.0}
+        stat["calls"] += 1
+        stat["total_s"] += seconds
+        stat["self_s"] += seconds - child_seconds
+        stat["min_s"] = min(stat["min_s"], seconds)
+        stat["max_s"] = max(stat["max_s"], seconds)
+        stat["rows_in"] += rows_in or 0
+        stat["rows_out"] += rows_out or 0
+        stat["rss_delta_mb"] += rss_delta / 1024**2
+
+        args = {"rss_delta_mb": round(rss_delta / 1024**2, 3)}
+        if rows_in is not None:
+            args["rows_in"] = rows_in
+        if rows_out is not None:
+            args["rows_out"] = rows_out
+        _events.append({"name": name, "ph": "X", "ts": (start - _epoch) * 1e6, "dur": seconds * 1e6,
+                        "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+
+class _Span:
+    """One timed call, nested spans subtract their time from the parent's self time."""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.child_seconds = 0.0
+        self.rss = _rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        rss_delta = _rss() - self.rss
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child_seconds += seconds
+        _record(self.name, self.start, seconds, self.child_seconds, self.rows_in, self.rows_out, rss_delta)
+        return False
+
+
+def timed(func=None, name=None):
+    """Decorator recording every call of func while instrumentation is enabled.
+
+    Rows in are taken from the first frame/series argument, rows out from the result.
+
+    Keyword arguments:
+    func -- the function to wrap
+    name -- name in the summary, default is module.qualname
+    """
+    if func is None:
+        return functools.partial(timed, name=name)
+    name = name or f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        rows_in = next((rows for rows in map(_rows, args) if rows is not None), None)
+        with _Span(name, rows_in) as span:
+            result = func(*args, **kwargs)
+            span.rows_out = _rows(result)
+        return result
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def section(name, rows=None):
+    """Time a block of code under name, e.g. the figure construction of a report.
+
+    Keyword arguments:
+    name -- name in the summary
+    rows -- optional number of input rows of the block
+    """
+    if not ENABLED:
+        yield None
+        return
+    with _Span(name, rows) as span:
+        yield span
+
+
+def summary():
+    """Recorded stats per name, sorted by cumulative time, as dict."""
+    with _lock:
+        stats = {name: dict(stat, mean_s=stat["total_s"] / stat["calls"]) for name, stat in _stats.items()}
+    return dict(sorted(stats.items(), key=lambda item: item[1]["total_s"], reverse=True))
+
+
+def summary_df():
+    """summary() as data frame, one row per instrumented function / section."""
+    import pandas as pd
+    return pd.DataFrame.from_dict(summary(), orient="index")
+
+
+def write_json(path):
+    """Write summary() as json."""
+    with open(path, "w") as f:
+        json.dump(summary(), f, indent=2)
+
+
+def write_chrome_trace(path):
+    """Write all recorded calls in the Chrome trace event format."""
+    with _lock:
+        events = list(_events)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+@atexit.register
+def _export_at_exit():
+    """Write the files named by RMS_PROFILE_JSON / RMS_PROFILE_TRACE, if set."""
+    if os.environ.get("RMS_PROFILE_JSON") and _stats:
+        write_json(os.environ["RMS_PROFILE_JSON"])
+    if os.environ.get("RMS_PROFILE_TRACE") and _events:
+        write_chrome_trace(os.environ["RMS_PROFILE_TRACE"])
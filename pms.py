@@ -1,32 +1,151 @@
+"""Plots and store infos on top of rms.
+
+Importing pms is headless: plotly (graph_objs, express, make_subplots) is imported on the
+first figure, so data-only users (get_store_info, box_summary, downsample, e.g. in batch
+workers) neither pay for the plotting stack nor need it installed.
+"""
 import numpy as np
 import pandas as pd
-import plotly.graph_objs as go
-import plotly.express as px
+import instrument
 import rms
-from plotly.subplots import make_subplots
 
+_PLOTLY_NAMES = ("go", "px", "make_subplots")
+
+
+def _plotly():
+    """Import the plotting stack into the module globals on first use."""
+    global go, px, make_subplots
+    if "make_subplots" in globals():
+        return
+    import plotly.express
+    import plotly.graph_objs
+    from plotly.subplots import make_subplots as _make_subplots
+    go, px, make_subplots = plotly.graph_objs, plotly.express, _make_subplots
+
+
+def __getattr__(name):
+    # pms.go & Co. von außen laden plotly ebenfalls erst bei Bedarf
+    if name in _PLOTLY_NAMES:
+        _plotly()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Punktebudget je Trace, darüber wird heruntergerechnet (None = alle Punkte)
+MAX_POINTS = 2000
+
+
+def lttb(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: positions of n_out points that keep the shape of the line.
+
+    Keyword arguments:
+    x -- the x values as float array, sorted
+    y -- the y values as float array
+    n_out -- number of points to keep, incl. the first and the last one
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
 
-def plot_sales_customers(data, grpby):
+    x = x - x[0]
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    edges = np.r_[edges, n]
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, stop, next_stop = edges[i], edges[i + 1], edges[i + 2]
+        avg_x, avg_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + area.argmax()
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(series, max_points=MAX_POINTS):
+    """Reduce a series to at most max_points points with LTTB, series within the budget are returned as is.
+
+    Keyword arguments:
+    series -- the series to plot, index is the x axis (numbers or dates)
+    max_points -- the point budget, None keeps all points
+    """
+    if max_points is None or len(series) <= max_points:
+        return series
+    series = series.dropna()
+    x = series.index.asi8 if isinstance(series.index, pd.DatetimeIndex) else series.index.to_numpy()
+    return series.iloc[lttb(np.asarray(x, dtype=float), series.to_numpy(dtype=float), max_points)]
+
+
+def box_summary(data, by, col):
+    """Quantiles, mean and whisker ends (1.5 IQR) of col per value of by, as plotly needs them for precomputed boxes."""
+    grouped = data.groupby(by, observed=True)[col]
+    summary = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    summary.columns = ["q1", "median", "q3"]
+    summary["mean"] = grouped.mean()
+
+    iqr = summary.q3 - summary.q1
+    values = data[col].to_numpy()
+    lower = (summary.q1 - 1.5 * iqr).reindex(data[by]).to_numpy()
+    upper = (summary.q3 + 1.5 * iqr).reindex(data[by]).to_numpy()
+    keys = data[by].to_numpy()
+    summary["lowerfence"] = pd.Series(values[values >= lower]).groupby(keys[values >= lower]).min()
+    summary["upperfence"] = pd.Series(values[values <= upper]).groupby(keys[values <= upper]).max()
+    return summary
+
+
+def _all_categories(index):
+    """Every combination of the categories of a group index, as groupby(observed=False) gives it."""
+    def categories(level):
+        return pd.CategoricalIndex(level.categories, dtype=level.dtype, name=level.name) if isinstance(level, pd.CategoricalIndex) else level
+
+    if isinstance(index, pd.MultiIndex):
+        return pd.MultiIndex.from_product([categories(level) for level in index.levels], names=index.names)
+    return categories(index)
+
+
+def _sales_customers_stats(data, grpby):
+    """Count, means and totals of Sales and Customers by grpby, from data or (data=None) from the rollup cube."""
+    if data is None:
+        grouped = rms.rollup([grpby] if isinstance(grpby, str) else grpby, freq=None)
+        # wie groupby(observed=False) unten: auch Kategorien ohne offene Tage
+        grouped = grouped.reindex(_all_categories(grouped.index), fill_value=0)
+        return {"Count": grouped["count"],
+                "Sales per Customer": grouped.Sales / grouped.Customers,
+                "Sales (mean)": grouped.Sales / grouped["count"],
+                "Customers (mean)": grouped.Customers / grouped["count"],
+                "Sales (total)": grouped.Sales,
+                "Customers (total)": grouped.Customers,
+               }
+
+    grouped = data.groupby(grpby, observed=False)
+
+    return {"Count": grouped.Sales.count(),
+            "Sales per Customer": grouped.Sales.sum() / grouped.Customers.sum(),
+            "Sales (mean)": grouped.Sales.mean(),
+            "Customers (mean)": grouped.Customers.mean(),
+            "Sales (total)": grouped.Sales.sum(),
+            "Customers (total)": grouped.Customers.sum(),
+           }
+
+
+@instrument.timed
+def plot_sales_customers(data, grpby, show=True):
     """"Plot sales and customer info as barplots in a neat grid.
     
     Keyword arguments:
-    data -- the data frame to plot from, must have Sales, Customers and grpby as columns
+    data -- the data frame to plot from, must have Sales, Customers and grpby as columns,
+            None answers from the rollup cube of all open days (rms.rollup)
     grpbyy -- the column(s?) to groupby
+    show -- show the figure, else it is only returned
     """
 
-    grouped = data.groupby(grpby, observed=False)
-
-    plots = {"Count": grouped.Sales.count(),
-             "Sales per Customer": grouped.Sales.sum() / grouped.Customers.sum(),
-             "Sales (mean)": grouped.Sales.mean(),
-             "Customers (mean)": grouped.Customers.mean(),
-             "Sales (total)": grouped.Sales.sum(),
-             "Customers (total)": grouped.Customers.sum(),
-            }
+    plots = _sales_customers_stats(data, grpby)
     
     cols = 2
     rows = int(np.ceil(len(plots)/cols))
 
+    _plotly()
     fig = make_subplots(rows=rows, cols=cols, start_cell="top-left", subplot_titles=list(plots.keys()))
 
     suplot_iterator = [(i, j) for i in range(1, rows+1) for j in range(1, cols+1)]
@@ -35,30 +154,27 @@ def plot_sales_customers(data, grpby):
             fig.add_trace(go.Bar(x=plots[p].index, y=plots[p].values, name=p), row=i, col=j)
     
     fig.update_layout(width=1100, height=800, title_text=grpby, showlegend=False)
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
 
+@instrument.timed
 def plot_sales_customers2(data, grpby):
     """"Plot sales and customer info as barplots in a neat grid.
     
     Keyword arguments:
-    data -- the data frame to plot from, must have Sales and Customers as columns
+    data -- the data frame to plot from, must have Sales and Customers as columns,
+            None answers from the rollup cube of all open days (rms.rollup)
     grpbyy -- the column(s?) to groupby
     """
 
-    grouped = data.groupby(grpby, observed=False)
-
-    plots = {"Count": grouped.Sales.count(),
-             "Sales per Customer": grouped.Sales.sum() / grouped.Customers.sum(),
-             "Sales (mean)": grouped.Sales.mean(),
-             "Customers (mean)": grouped.Customers.mean(),
-             "Sales (total)": grouped.Sales.sum(),
-             "Customers (total)": grouped.Customers.sum(),
-            }
+    plots = _sales_customers_stats(data, grpby)
     
     cols = 2
     rows = int(np.ceil(len(plots)/cols))
 
+    _plotly()
     fig = make_subplots(rows=rows, cols=cols, start_cell="top-left", subplot_titles=list(plots.keys()))
 
     suplot_iterator = [(i, j) for i in range(1, rows+1) for j in range(1, cols+1)]
@@ -70,20 +186,27 @@ def plot_sales_customers2(data, grpby):
     fig.show()
 
 
-def keep_rolling(data, col, windows_list):
+@instrument.timed
+def keep_rolling(data, col, windows_list, show=True, max_points=MAX_POINTS):
     """Plot (time series) data as line graphs with rolling windows using plotly.
 
     Keyword arguments:
     data -- the data frame to plot from
     col -- the column(s?) from the data frame to plot
     windows_list -- the list of rolling window values to plot
+    show -- show the figure, else it is only returned
+    max_points -- point budget per trace, longer traces are downsampled with LTTB
     """
 
+    _plotly()
     fig = go.Figure()
-    fig.add_traces(go.Scatter(x=data.index, y=data[col] , mode='lines', line={"dash": "dot"}, name = f"{col}", opacity=0.4))
+    plot_me = downsample(data[col], max_points)
+    fig.add_traces(go.Scatter(x=plot_me.index, y=plot_me.values, mode='lines', line={"dash": "dot"}, name = f"{col}", opacity=0.4))
 
+    rolling = rms.compute_metrics(data, metrics=[], windows=windows_list, columns=[col])
     for window in windows_list:
-        fig.add_traces(go.Scatter(x=data.index, y=data[col].rolling(window=window, center=True).mean() , mode='lines+markers', name = f"MA{window}", opacity=0.6))
+        plot_me = downsample(rolling[f"{col}_ma{window}"], max_points)
+        fig.add_traces(go.Scatter(x=plot_me.index, y=plot_me.values, mode='lines+markers', name = f"MA{window}", opacity=0.6))
 
     if ("CompetitionSince" in data.columns):
         competition_since = data.CompetitionSince.iloc[0]
@@ -100,57 +223,81 @@ def keep_rolling(data, col, windows_list):
 
     fig.update_layout(title=f"{col} over time", width=1100)
 
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
 
-def plotly_boxes(data, col):
+@instrument.timed
+def plotly_boxes(data, col, show=True, max_points=MAX_POINTS):
     """Plot Sales and Customers data as boxplots by col using plotly.
 
     Keyword arguments:
     data -- the data frame to plot from
     col -- the column(s?) from the data frame to plot
+    show -- show the figure, else it is only returned
+    max_points -- up to this many rows every point is drawn, above only the precomputed box summary
     """
+    _plotly()
     fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.05)
-    fig.add_trace(go.Box(x=data[col], y=data.Sales, boxmean=True, boxpoints='all', jitter=0.4, text=data.index.date, name="Sales (EUR)"), row=1, col=1)
-    fig.add_trace(go.Box(x=data[col], y=data.Customers, boxmean=True, boxpoints='all', jitter=0.4, text=data.index.date, name="Customers"), row=2, col=1)
+    for row, (y, name) in enumerate([("Sales", "Sales (EUR)"), ("Customers", "Customers")], start=1):
+        if max_points is None or len(data) <= max_points:
+            box = go.Box(x=data[col], y=data[y], boxmean=True, boxpoints='all', jitter=0.4, text=data.index.date, name=name)
+        else:
+            summary = box_summary(data, col, y)
+            box = go.Box(x=summary.index, q1=summary.q1, median=summary["median"], q3=summary.q3, mean=summary["mean"],
+                         lowerfence=summary.lowerfence, upperfence=summary.upperfence, boxmean=True, boxpoints=False, name=name)
+        fig.add_trace(box, row=row, col=1)
     fig.update_layout(height=800, width=1100, title_text=f"Sales, Customers by {col}", showlegend=False)
     fig.update_xaxes(tickmode = 'array', tickvals = [0, 1], ticktext = [f'No {col}', f'{col}'])
     fig.update_yaxes(title_text="Sales (EUR)", row=1, col=1)
     fig.update_yaxes(title_text="Customers", row=2, col=1)
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
 
+@instrument.timed
 def print_store_info(store_id):
     """"Gather infos on a specific store an print them in a neat table."""
     if store_id > 1115:
         print(f"StoreID {store_id} out of range (1 - 1115)")
         return
-        
+
+    store_info = get_store_info(store_id)
+    
+    print(f"***** General Information about Store {store_id} ***** \n")
+    for k, v in store_info.items():
+        print(f"{k:.<25}: {v}")
+
+    return pd.DataFrame(store_info, index=[store_id])
+
+
+@instrument.timed
+def get_store_info(store_id, data=None, ranking=None):
+    """"Gather infos on a specific store as dict of formatted strings.
+
+    Keyword arguments:
+    store_id -- the store
+    data -- the store's merged daily data with Date as index, default is rms.get_store_data_df(store_id)
+    ranking -- the store ranking table, default is rms.get_store_ranking_df()
+    """
     # gather data
-    train = rms.get_train_df()
-    data = rms.get_store_data_df(store_id)
+    ranking = rms.get_store_ranking_df() if ranking is None else ranking
+    data = rms.get_store_data_df(store_id) if data is None else data
     data_open = data.loc[data.Open==1]
     
-    # top-lists
-    top_total_sales = train.groupby("Store").Sales.sum().sort_values(ascending=False)
-    top_total_customers = train.groupby("Store").Customers.sum().sort_values(ascending=False)    
-    top_mean_sales = train.groupby("Store").Sales.mean().sort_values(ascending=False)
-    top_mean_open_sales = train[train.Open==1].groupby("Store").Sales.mean().sort_values(ascending=False)
-    top_mean_customers = train.groupby("Store").Customers.mean().sort_values(ascending=False)
-    top_mean_open_customers = train[train.Open==1].groupby("Store").Customers.mean().sort_values(ascending=False)
-    top_spc = (top_total_sales/top_total_customers).sort_values(ascending=False)
-
     # ranks
-    sales_total_rank = top_total_sales.index.get_loc(store_id) + 1
-    sales_mean_rank = top_mean_sales.index.get_loc(store_id) + 1
-    sales_mean_open_rank = top_mean_open_sales.index.get_loc(store_id) + 1
-    customers_total_rank = top_total_customers.index.get_loc(store_id) + 1
-    customers_mean_rank = top_mean_customers.index.get_loc(store_id) + 1
-    customers_mean_open_rank = top_mean_open_customers.index.get_loc(store_id) + 1
-    spc_rank = top_spc.index.get_loc(store_id) + 1
+    sales_total_rank = ranking.at[store_id, "sales_total_rank"]
+    sales_mean_rank = ranking.at[store_id, "sales_mean_rank"]
+    sales_mean_open_rank = ranking.at[store_id, "sales_mean_open_rank"]
+    customers_total_rank = ranking.at[store_id, "customers_total_rank"]
+    customers_mean_rank = ranking.at[store_id, "customers_mean_rank"]
+    customers_mean_open_rank = ranking.at[store_id, "customers_mean_open_rank"]
+    spc_rank = ranking.at[store_id, "spc_rank"]
 
     # some helper variables
-    n_stores = len(train.groupby("Store"))
+    n_stores = len(ranking)
     n_days = len(data)    
     n_days_open = len(data_open)
     n_holidays = (data.StateHoliday != '0').sum()
@@ -203,14 +350,11 @@ def print_store_info(store_id):
     if is_promo2:
         store_info["since"] = f"{data.Promo2Since.iloc[0]}"
         store_info["Intervall"] = f"{data.PromoInterval.iloc[0]}"
-    
-    print(f"***** General Information about Store {store_id} ***** \n")
-    for k, v in store_info.items():
-        print(f"{k:.<25}: {v}")
 
-    return pd.DataFrame(store_info, index=[store_id])
+    return store_info
 
 
+@instrument.timed
 def plot_impact(col, data_type, min_days=None):
     """"Plot impact of an event on a specific column.
     
@@ -218,7 +362,7 @@ def plot_impact(col, data_type, min_days=None):
         col -- the colum to plot
         data_type -- type of the event, default is "competition", "promo2" is the other valid option atm
         min_days -- only use stores that have at least min_days before and after the event"""
-    data_open_df = rms.get_data_open_df()
+    data_open_df = rms.get_data_open_df(compact=True)
     competition_impact_df = rms.get_impact_df(data_open_df, data_type=data_type)
     
     if min_days != None:
@@ -227,6 +371,7 @@ def plot_impact(col, data_type, min_days=None):
     plot_me = competition_impact_df.sort_values(by=col, ascending=False).reset_index()
     mean_pos = (plot_me[col].mean() - plot_me[col]).abs().argsort()[0]
 
+    _plotly()
     if data_type == "competition":
         fig = px.bar(plot_me, x=plot_me.index, y=col, hover_data=["store"], color="competition_distance", width=1100, title=f"{data_type} impact on {col} by stores")
     else:
@@ -238,23 +383,25 @@ def plot_impact(col, data_type, min_days=None):
     fig.show()
 
 
-def plot_shared_x(col1, col2, freq="M"):
-    """"Plot two columns on shared x axis."""
-    data = rms.get_data_open_df()
-    # data = rms.get_metrics(data)
+@instrument.timed
+def plot_shared_x(col1, col2, freq="M", max_points=MAX_POINTS):
+    """"Plot two columns on shared x axis, longer series than max_points are downsampled with LTTB.
+
+    The sums per period come from the rollup cube, freq is a pandas frequency ("D", "W" and "M" are materialized)."""
+    plot_me = rms.rollup(freq=freq)[["Sales", "Customers"]]
+    plot_me = rms.get_metrics(plot_me, [col for col in [col1, col2] if col in rms.METRIC_COLUMNS])
 
-    plot_me_col1 = data.resample(freq, level=1)[["Sales", "Customers"]].sum()
-    plot_me_col1 = rms.get_metrics(plot_me_col1)
-    plot_me_col1 = plot_me_col1[col1]
+    plot_me_col1 = plot_me[col1]
+    plot_me_col2 = plot_me[col2]
 
-    plot_me_col2 = data.resample(freq, level=1)[["Sales", "Customers"]].sum()
-    plot_me_col2 = rms.get_metrics(plot_me_col2)
-    plot_me_col2 = plot_me_col2[col2]
+    plot_me_col1 = downsample(plot_me_col1, max_points)
+    plot_me_col2 = downsample(plot_me_col2, max_points)
 
 
     # plot_me_sales = data.resample(freq, level=1)[col1].sum()
     # plot_me_customers = data.resample(freq, level=1)[col2].sum()
 
+    _plotly()
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     fig.add_trace(go.Scatter(x=plot_me_col1.index, y=plot_me_col1.values, name=col1), secondary_y=False)
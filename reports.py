@@ -0,0 +1,190 @@
+"""Render the store reports of pms for all stores to files, without a browser.
+
+    python reports.py --jobs 4
+
+writes reports/<store>/ with the store info (html/json) and the figures (html/json).
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import pms
+import rms
+
+
+REPORTS_DIR = "reports"
+FORMATS = ("html", "json")
+ROLLING_WINDOWS = [7, 28]
+TIMINGS_COLUMNS = ["store", "step", "seconds", "error"]
+
+
+def _store_fingerprints(data_df, ranking, formats):
+    """A fingerprint per store of everything its report is built from.
+
+    Combines the hash of the store's daily rows, of its store.csv row and of its ranking row,
+    so a store is rendered again if its data changed or if another store moved its ranks.
+    """
+    row_hashes = pd.util.hash_pandas_object(data_df, index=True).to_numpy()
+    stores = data_df.index.get_level_values("Store").to_numpy()
+    starts = np.flatnonzero(np.r_[True, stores[1:] != stores[:-1]])
+    data_hashes = pd.Series(np.add.reduceat(row_hashes, starts), index=stores[starts])
+
+    ranking_hashes = pd.util.hash_pandas_object(ranking, index=True)
+    return {int(store): f"{data_hashes[store]:016x}-{ranking_hashes[store]:016x}-{'+'.join(formats)}"
+            for store in data_hashes.index}
+
+
+def _write_figure(fig, path, formats):
+    if "html" in formats:
+        fig.write_html(f"{path}.html", include_plotlyjs="cdn")
+    if "json" in formats:
+        with open(f"{path}.json", "w") as f:
+            f.write(fig.to_json())
+
+
+def render_store_report(store_id, data, info, out_dir=REPORTS_DIR, formats=FORMATS):
+    """Render the report of one store to out_dir/<store_id>/ and return the timings per step.
+
+    Keyword arguments:
+    store_id -- the store
+    data -- the store's merged daily data with Date as index
+    info -- the store info dict of pms.get_store_info
+    out_dir -- the reports directory
+    formats -- "html" and/or "json"
+    """
+    store_dir = os.path.join(out_dir, str(store_id))
+    os.makedirs(store_dir, exist_ok=True)
+    data_open = data.loc[data.Open==1]
+    timings = []
+
+    start = time.perf_counter()
+    if "html" in formats:
+        pd.DataFrame(info, index=[store_id]).T.to_html(os.path.join(store_dir, "info.html"))
+    if "json" in formats:
+        with open(os.path.join(store_dir, "info.json"), "w") as f:
+            json.dump(info, f, indent=2)
+    timings.append({"store": store_id, "step": "info", "seconds": time.perf_counter() - start})
+
+    figures = {"sales": lambda: pms.keep_rolling(data_open, "Sales", ROLLING_WINDOWS, show=False),
+               "promo": lambda: pms.plotly_boxes(data_open, "Promo", show=False),
+               "weekday": lambda: pms.plot_sales_customers(data_open, "DayOfWeek", show=False)}
+    for name, build in figures.items():
+        start = time.perf_counter()
+        fig = build()
+        figure_seconds = time.perf_counter() - start
+        _write_figure(fig, os.path.join(store_dir, name), formats)
+        timings.append({"store": store_id, "step": f"{name} figure", "seconds": figure_seconds})
+        timings.append({"store": store_id, "step": f"{name} write", "seconds": time.perf_counter() - start - figure_seconds})
+    return timings
+
+
+def _load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {int(store): fingerprint for store, fingerprint in json.load(f).items()}
+
+
+def _save_manifest(manifest, path):
+    with open(path, "w") as f:
+        json.dump({str(store): fingerprint for store, fingerprint in sorted(manifest.items())}, f, indent=1)
+
+
+def generate_reports(ids=None, n_jobs=None, out_dir=REPORTS_DIR, formats=FORMATS, force=False):
+    """Render the reports of many stores on a process pool and return the timings per step.
+
+    The merged data and the ranking are loaded once; the report data of every store is computed
+    from them in this process, workers only build and write the figures. Stores whose
+    fingerprint matches out_dir/manifest.json are skipped. Timings of this run are written to
+    out_dir/timings.csv, stores whose report failed are listed with step "error" and the
+    exception in the error column; their full tracebacks go to out_dir/errors.json.
+
+    Keyword arguments:
+    ids -- list of store ids, default is all stores
+    n_jobs -- number of worker processes, default is the number of CPUs, 1 runs in-process
+    out_dir -- the reports directory
+    formats -- "html" and/or "json"
+    force -- render all stores, even unchanged ones
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    timings = []
+    errors = {}
+
+    def step(name, func):
+        start = time.perf_counter()
+        result = func()
+        timings.append({"store": "all", "step": name, "seconds": time.perf_counter() - start})
+        return result
+
+    data_df = step("load", rms.get_data_df)
+    ranking = step("ranking", rms.get_store_ranking_df)
+    fingerprints = step("fingerprint", lambda: _store_fingerprints(data_df, ranking, formats))
+
+    manifest = {} if force else _load_manifest(manifest_path)
+    stores = fingerprints.keys() if ids is None else ids
+    todo = [int(store) for store in stores if manifest.get(int(store)) != fingerprints[int(store)]]
+
+    def tasks():
+        for store in todo:
+            start = time.perf_counter()
+            data = data_df.loc[store]
+            info = pms.get_store_info(store, data, ranking)
+            timings.append({"store": store, "step": "report data", "seconds": time.perf_counter() - start})
+            yield store, data, info
+
+    def done(store, result):
+        if isinstance(result, Exception):
+            message = traceback.format_exception_only(result)[-1].strip()
+            timings.append({"store": store, "step": "error", "seconds": np.nan, "error": message})
+            # aus dem Worker-Prozess hängt der Original-Traceback als __cause__ an
+            errors[store] = "".join(traceback.format_exception(result))
+            return
+        timings.extend(result)
+        manifest[store] = fingerprints[store]
+
+    try:
+        if n_jobs == 1:
+            for store, data, info in tasks():
+                try:
+                    done(store, render_store_report(store, data, info, out_dir, formats))
+                except Exception as e:
+                    done(store, e)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = {pool.submit(render_store_report, store, data, info, out_dir, formats): store
+                           for store, data, info in tasks()}
+                for future in as_completed(futures):
+                    done(futures[future], future.exception() or future.result())
+    finally:
+        _save_manifest(manifest, manifest_path)
+        with open(os.path.join(out_dir, "errors.json"), "w") as f:
+            json.dump({str(store): error for store, error in sorted(errors.items())}, f, indent=1)
+
+    timings = pd.DataFrame(timings, columns=TIMINGS_COLUMNS)
+    timings.to_csv(os.path.join(out_dir, "timings.csv"), index=False)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stores", type=int, nargs="+")
+    parser.add_argument("--jobs", type=int)
+    parser.add_argument("--out-dir", default=REPORTS_DIR)
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=list(FORMATS))
+    parser.add_argument("--force", action="store_true", help="render unchanged stores too")
+    args = parser.parse_args()
+
+    timings = generate_reports(args.stores, args.jobs, args.out_dir, args.formats, args.force)
+    print(f"{timings.store.loc[timings.store != 'all'].nunique()} stores rendered")
+    failed = timings.loc[timings.step == "error"]
+    if len(failed):
+        print(f"{len(failed)} stores failed, see {os.path.join(args.out_dir, 'errors.json')}")
+        print(failed[["store", "error"]].to_string(index=False))
+    print(timings.groupby("step").seconds.agg(["count", "sum", "mean"]))
@@ -1,16 +1,342 @@
+import json
+import os
+import re
+import uuid
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
+import instrument
 
-def get_train_df():
+
+TRAIN_CSV = "train.csv"
+STORE_CSV = "store.csv"
+
+TRAIN_COLUMNS = ["Store", "DayOfWeek", "Date", "Sales", "Customers", "Open", "Promo", "StateHoliday", "SchoolHoliday"]
+TRAIN_DTYPES = {"Store": "int16", "DayOfWeek": "int8", "Sales": "int32", 
+                "Customers": "int16", "Open": "int8", "Promo": "int8", 
+                "StateHoliday": "category", "SchoolHoliday": "int8"}
+
+# Spaltenweiser Snapshot (ein .npy pro Spalte), siehe write_snapshot()
+SNAPSHOT_DIR = "snapshot"
+USE_SNAPSHOT = True
+
+METRIC_COLUMNS = ["spc", "cum_sales", "pct_change_sales", "diff_sales",
+                  "cum_customers", "pct_change_customers", "diff_customers"]
+
+# Zeilen pro Chunk im Streaming-Modus
+CHUNK_SIZE = 100_000
+
+# Speicherbudget (Bytes) für abgeleitete Frames (merged, open-only, weekly)
+CACHE_BUDGET = 1024**3
+
+# Rollup-Cube: Cuboid -> (Dimensionen, materialisierte Auflösungen); tageweise je Filiale sind das die Rohdaten
+ROLLUP_CUBOIDS = {"attributes": (["StoreType", "Assortment", "Promo", "StateHoliday", "DayOfWeek"], ["D", "W", "M"]),
+                  "store": (["Store", "Promo"], ["W", "M"])}
+
+_base_cache = {}
+_derived_cache = OrderedDict()
+
+
+def _source_key(path):
+    """Identify a source file by absolute path, mtime and size."""
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _freeze(df):
+    """Make the blocks of df read-only so cached frames can't be changed in place.
+
+    Extension arrays (categorical, nullable int, datetime) are frozen via their numpy buffers."""
+    for block in df._mgr.blocks:
+        values = block.values
+        if isinstance(values, np.ndarray):
+            values.flags.writeable = False
+            continue
+        for attr in ["_codes", "_ndarray", "_data", "_mask"]:
+            buffer = getattr(values, attr, None)
+            if isinstance(buffer, np.ndarray):
+                buffer.flags.writeable = False
+    return df
+
+
+def _view(df):
+    """Shallow copy of a cached frame.
+
+    New columns can be added to the view, but writing into existing values raises."""
+    return df.copy(deep=False)
+
+
+def _get_base(name, path, reader):
+    """Return the cached frame for a source file, (re)reading it if it changed on disk."""
+    key = _source_key(path)
+    cached = _base_cache.get(name)
+    if cached is None or cached[0] != key:
+        _base_cache[name] = (key, _freeze(reader(path)))
+        # alles Abgeleitete hängt an den alten Quelldateien
+        _derived_cache.clear()
+    return _base_cache[name][1]
+
+
+def _get_derived(key, builder):
+    """Return a derived frame from the LRU cache, building it with builder() on a miss.
+
+    Keyword arguments:
+    key -- hashable key, e.g. ("weekly", store_id)
+    builder -- function without arguments that builds the frame
+    """
+    # Quelldateien zuerst prüfen, damit veraltete Einträge verworfen werden
+    key = (_source_key(TRAIN_CSV), _source_key(STORE_CSV)) + tuple(key)
+    if key in _derived_cache:
+        _derived_cache.move_to_end(key)
+        return _derived_cache[key][1]
+
+    df = _freeze(builder())
+    nbytes = int(df.memory_usage(deep=True).sum())
+    _derived_cache[key] = (nbytes, df)
+    _evict()
+    return df
+
+
+def _peek_derived(key):
+    """Return a derived frame if it is cached, else None, without building it."""
+    key = (_source_key(TRAIN_CSV), _source_key(STORE_CSV)) + tuple(key)
+    cached = _derived_cache.get(key)
+    if cached is None:
+        return None
+    _derived_cache.move_to_end(key)
+    return cached[1]
+
+
+def _evict():
+    """Drop least recently used derived frames until the cache fits into CACHE_BUDGET."""
+    total = sum(nbytes for nbytes, _ in _derived_cache.values())
+    while total > CACHE_BUDGET and _derived_cache:
+        _, (nbytes, _) = _derived_cache.popitem(last=False)
+        total -= nbytes
+
+
+def set_cache_budget(nbytes):
+    """Set the memory budget for derived frames and evict what doesn't fit anymore."""
+    global CACHE_BUDGET
+    CACHE_BUDGET = nbytes
+    _evict()
+
+
+def invalidate_cache():
+    """Forget all cached frames. The next call reads the CSV files again."""
+    _base_cache.clear()
+    _derived_cache.clear()
+
+
+def refresh_cache():
+    """Invalidate the cache and read train.csv and store.csv right away."""
+    invalidate_cache()
+    get_train_df()
+    get_store_df()
+
+
+def cache_info():
+    """Return a df with one row per cached frame: kind, rows and memory in bytes."""
+    rows = []
+    for name, (key, df) in _base_cache.items():
+        rows.append({"frame": name, "rows": len(df), "bytes": int(df.memory_usage(deep=True).sum())})
+    for key, (nbytes, df) in _derived_cache.items():
+        rows.append({"frame": "/".join(str(k) for k in key[2:]), "rows": len(df), "bytes": nbytes})
+    return pd.DataFrame(rows, columns=["frame", "rows", "bytes"])
+
+
+def _snapshot_source(path):
+    """Size and mtime of a source file as recorded in the snapshot meta data."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _write_columns(df, path, source):
+    """Write df column by column as .npy files plus a meta.json into path.
+
+    The files of every write get new names and meta.json is swapped in with os.replace at the
+    end, so frames still memory-mapping the previous files keep their data; the files of the
+    previous meta.json are unlinked afterwards (the mapping keeps them alive), other files
+    in path are left alone.
+
+    Keyword arguments:
+    df -- the frame to write, index levels are written as columns
+    path -- the target directory
+    source -- the csv file the frame was built from
+    """
+    os.makedirs(path, exist_ok=True)
+    version = uuid.uuid4().hex[:12]
+
+    columns = []
+    for i, (name, col) in enumerate(df.reset_index().items()):
+        entry = {"name": name, "file": f"{i}-{version}.npy", "dtype": str(col.dtype)}
+        if col.dtype == object:
+            # np.save kann ohne Pickle keine Objekte, Strings werden als Kategorien gespeichert
+            col = col.astype("category")
+            entry["object"] = True
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            values = col.cat.codes.to_numpy()
+            entry["categories"] = col.cat.categories.tolist()
+            entry["ordered"] = bool(col.cat.ordered)
+        elif isinstance(col.array, pd.arrays.IntegerArray):
+            values = col.to_numpy(dtype=col.dtype.numpy_dtype, na_value=0)
+            entry["mask"] = f"{i}_mask-{version}.npy"
+            np.save(os.path.join(path, entry["mask"]), col.isna().to_numpy())
+        else:
+            values = col.to_numpy()
+        np.save(os.path.join(path, entry["file"]), values, allow_pickle=False)
+        columns.append(entry)
+
+    meta = {"source": _snapshot_source(source), "index": list(df.index.names), "columns": columns}
+
+    # Partitionsindex: die Zeilen einer Filiale liegen am Stück, Store -> [start, stop)
+    if isinstance(df.index, pd.MultiIndex) and df.index.names[0] == "Store":
+        stores, starts, counts = np.unique(df.index.get_level_values(0).to_numpy(), return_index=True, return_counts=True)
+        meta["partitions"] = f"stores-{version}.npy"
+        np.save(os.path.join(path, meta["partitions"]), np.column_stack([stores, starts, starts + counts]).astype("int64"))
+
+    meta_path = os.path.join(path, "meta.json")
+    old = _snapshot_files(meta_path)
+    with open(f"{meta_path}.{version}", "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(f"{meta_path}.{version}", meta_path)
+
+    # nur die Dateien des vorigen Snapshots und liegengebliebene meta.json-Zwischenstände,
+    # save_frame darf in beliebige Verzeichnisse schreiben
+    stale = old - _snapshot_files(meta_path)
+    stale |= {name for name in os.listdir(path) if re.fullmatch(r"meta\.json\.[0-9a-f]{12}", name)}
+    for name in stale:
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            # z.B. unter Windows, solange die Datei noch gemappt ist
+            pass
+
+
+def _snapshot_files(meta_path):
+    """Names of the .npy files a meta.json references, empty if there is none."""
+    if not os.path.exists(meta_path):
+        return set()
+    with open(meta_path) as f:
+        meta = json.load(f)
+    files = {entry[key] for entry in meta["columns"] for key in ("file", "mask") if key in entry}
+    return files | ({meta["partitions"]} if "partitions" in meta else set())
+
+
+def _store_rows(path, store_id):
+    """Look up the row range [start, stop) of store_id in a partition index file of a snapshot."""
+    stores = np.load(path, mmap_mode="r")
+    pos = np.searchsorted(stores[:, 0], store_id)
+    if pos == len(stores) or stores[pos, 0] != store_id:
+        raise KeyError(store_id)
+    return slice(int(stores[pos, 1]), int(stores[pos, 2]))
+
+
+@instrument.timed
+def _read_columns(path, source, store_id=None):
+    """Memory-map a snapshot written by _write_columns.
+
+    Returns None if there is no snapshot or if source changed since it was written.
+    Keyword arguments:
+    path -- the snapshot directory
+    source -- the csv file the snapshot was built from
+    store_id -- only read the rows of this store (needs a partitioned snapshot)
+    """
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta["source"] != _snapshot_source(source):
+        return None
+
+    if store_id is not None and "partitions" not in meta:
+        return None
+
+    try:
+        rows = slice(None) if store_id is None else _store_rows(os.path.join(path, meta["partitions"]), store_id)
+        cols = {}
+        for entry in meta["columns"]:
+            values = np.load(os.path.join(path, entry["file"]), mmap_mode="r")[rows]
+            if "categories" in entry:
+                values = pd.Categorical.from_codes(values, categories=entry["categories"], ordered=entry["ordered"])
+                if entry.get("object"):
+                    values = np.asarray(values, dtype=object)
+            elif "mask" in entry:
+                mask = np.load(os.path.join(path, entry["mask"]), mmap_mode="r")[rows]
+                values = pd.arrays.IntegerArray(np.asarray(values), np.asarray(mask))
+            cols[entry["name"]] = values
+    except FileNotFoundError:
+        # zwischen dem Lesen von meta.json und der Spalten neu geschrieben
+        return None
+
+    if len(meta["index"]) == 1:
+        index = pd.Index(cols.pop(meta["index"][0]), name=meta["index"][0])
+    else:
+        index = pd.MultiIndex.from_arrays([cols.pop(name) for name in meta["index"]], names=meta["index"])
+    return pd.DataFrame(cols, index=index, copy=False)
+
+
+@instrument.timed
+def write_snapshot(path=None):
+    """Convert train.csv and store.csv into a columnar snapshot.
+
+    The typed, sorted frames (incl. isHoliday, CompetitionSince and Promo2Since) are written,
+    so loading them later skips csv parsing. A snapshot goes stale as soon as the csv changes.
+
+    Keyword arguments:
+    path -- the snapshot directory, default is SNAPSHOT_DIR
+    """
+    path = path or SNAPSHOT_DIR
+    _write_columns(_get_base("train", TRAIN_CSV, _load_train), os.path.join(path, "train"), TRAIN_CSV)
+    _write_columns(_get_base("store", STORE_CSV, _load_store), os.path.join(path, "store"), STORE_CSV)
+
+
+def save_frame(df, path):
+    """Save a frame derived from train.csv in the snapshot format, e.g. to share it with worker processes.
+
+    Frames indexed by (Store, ...) get a partition index, so single stores can be read back cheaply.
+    """
+    _write_columns(df, path, TRAIN_CSV)
+
+
+def load_frame(path, store_id=None):
+    """Memory-map a frame written by save_frame. Returns None if it is missing or train.csv changed since.
+
+    Keyword arguments:
+    path -- the directory the frame was saved to
+    store_id -- only read the rows of this store
+    """
+    return _read_columns(path, TRAIN_CSV, store_id=store_id)
+
+
+def _load_train(path):
+    """Load the train frame from the snapshot if it is up to date, else from csv."""
+    train_df = _read_columns(os.path.join(SNAPSHOT_DIR, "train"), path) if USE_SNAPSHOT else None
+    return _read_train_csv(path) if train_df is None else train_df
+
+
+def _load_store(path):
+    """Load the store frame from the snapshot if it is up to date, else from csv."""
+    store = _read_columns(os.path.join(SNAPSHOT_DIR, "store"), path) if USE_SNAPSHOT else None
+    return _read_store_csv(path) if store is None else store
+
+
+@instrument.timed
+def _read_train_csv(path):
     """Read train.csv with appropriate dtypes. Set Store and Date as Multiindex"""
-    train_df = pd.read_csv("train.csv", 
+    train_df = pd.read_csv(path, 
                         parse_dates=["Date"],
                         index_col=[0, 2], 
-                        dtype={"Store": "int16", "DayOfWeek": "int8", "Sales": "int32", 
-                               "Customers": "int16", "Open": "int8", "Promo": "int8", 
-                               "StateHoliday": "category", "SchoolHoliday": "int8"})
-    
+                        dtype=TRAIN_DTYPES)
+    return _prepare_train(train_df)
+
+
+@instrument.timed
+def _prepare_train(train_df):
+    """Add isHoliday and sort by Store and Date."""
     train_df.loc[:, "isHoliday"] = train_df.StateHoliday!="0"
 
     # StateHoliday 1-hot encoden
@@ -20,9 +346,11 @@ def get_train_df():
     
     return train_df
 
-def get_store_df():
+
+@instrument.timed
+def _read_store_csv(path):
     """"Read store.csv, do some date conversions and return the resulting df."""
-    store = pd.read_csv("store.csv",
+    store = pd.read_csv(path,
                         index_col=[0],    
                         dtype={"Store": "Int16", "StoreType": "category", "Assortment": "category", 
                                "CompetitionDistance": "Int32", "CompetitionOpenSinceMonth": "Int32", 
@@ -42,27 +370,114 @@ def get_store_df():
     return store
 
 
-def get_data_df():
-    """ Get train.csv and store.csv and merge them on store...obviously."""
-    train_df = get_train_df()
-    store_df = get_store_df()
-    
-    data_df = pd.merge(train_df.reset_index(), store_df.reset_index(), on="Store")
-    data_df = data_df.set_index(["Store", "Date"])
+@instrument.timed
+def get_train_df():
+    """Get train.csv with appropriate dtypes, Store and Date as Multiindex.
+
+    The parsed frame is cached until train.csv changes, callers get a read-only view."""
+    return _view(_get_base("train", TRAIN_CSV, _load_train))
 
+
+@instrument.timed
+def get_store_df():
+    """Get store.csv with date conversions, cached until store.csv changes."""
+    return _view(_get_base("store", STORE_CSV, _load_store))
+
+
+@instrument.timed
+def get_train_store_df(id):
+    """Get the train rows of a single store with Date as index.
+
+    Uses the cached train frame if there is one, else only the store's partition of the
+    snapshot is read. Falls back to loading everything if the snapshot is missing or stale.
+
+    Keyword arguments:
+    id -- store id to get data for
+    """
+    cached = _base_cache.get("train")
+    if cached is None or cached[0] != _source_key(TRAIN_CSV):
+        train_df = _read_columns(os.path.join(SNAPSHOT_DIR, "train"), TRAIN_CSV, store_id=id) if USE_SNAPSHOT else None
+        if train_df is not None:
+            return train_df.loc[id]
+    return get_train_df().loc[id]
+
+
+@instrument.timed
+def get_data_df(compact=False):
+    """ Get train.csv and store.csv and merge them on store...obviously.
+
+    Keyword arguments:
+    compact -- leave out the static store.csv columns, they are stored once in get_store_df()
+               and can be added with join_store_columns when needed
+    """
+    if compact:
+        return get_train_df()
+    return _view(_get_derived(("data",), _build_data_df))
+
+
+@instrument.timed
+def _build_data_df():
     # return get_metrics(data)
-    return data_df
+    return join_store_columns(get_train_df())
+
 
+@instrument.timed
+def get_data_open_df(compact=False):
+    """"Get merged data only for open days.
+
+    Keyword arguments:
+    compact -- leave out the static store.csv columns, see get_data_df
+    """
+    if compact:
+        return _view(_get_derived(("data_open_compact",), lambda: _only_open(get_train_df())))
+    return _view(_get_derived(("data_open",), lambda: _only_open(get_data_df())))
 
-def get_data_open_df():
-    """"Get merged data only for open days."""
-    data_df = get_data_df()
+
+def _only_open(data_df):
     return data_df.loc[data_df.Open==1]
 
 
+@instrument.timed
+def join_store_columns(df, columns=None):
+    """Add static store.csv columns to a frame indexed by Store (and Date), keeping their dtypes.
+
+    Only the requested columns are broadcast to the rows, the categoricals and small
+    nullable integers of get_store_df stay as they are.
+
+    Keyword arguments:
+    df -- the frame to add the columns to, e.g. get_data_df(compact=True)
+    columns -- the store.csv columns to add, default is all
+    """
+    store_df = get_store_df()
+    columns = list(store_df.columns) if columns is None else columns
+    positions = store_df.index.get_indexer(df.index.get_level_values("Store"))
+
+    df = df.copy(deep=False)
+    for col in columns:
+        df[col] = store_df[col].array.take(positions, allow_fill=True)
+    return df
+
+
+def memory_report(**frames):
+    """Memory per column in MB of the given frames, incl. index and total.
+
+    E.g. memory_report(merged=get_data_df(), compact=get_data_df(compact=True), store=get_store_df())
+    """
+    report = pd.DataFrame({name: df.memory_usage(deep=True) / 1024**2 for name, df in frames.items()})
+    report.loc["total"] = report.sum()
+    return report
+
+
+@instrument.timed
 def get_store_data_df(id):
     """Get data for a specific store. """
-    train_store = get_train_df().loc[id]
+    return _view(_get_derived(("store_data", id), lambda: get_metrics(_merge_store(get_train_store_df(id), id))))
+
+
+@instrument.timed
+def _merge_store(train_store, id):
+    """Merge the daily rows of store id with its store.csv info, Date as index."""
+    train_store = train_store.copy()
     train_store["Store"] = id
 
     store = get_store_df()
@@ -70,17 +485,103 @@ def get_store_data_df(id):
     data = pd.merge(train_store.reset_index(), store.reset_index(), on="Store")
     data = data.set_index("Date")
 
-    return get_metrics(data)
+    return data
 
 
-def get_stores_data_df():
+@instrument.timed
+def get_stores_data_df(chunksize=None):
     """ Get train.csv and store.csv, merge them on Store and groupby Store.
      
-    Returns the data aggregated by Store.  """
-    train_df = get_train_df()
-    store_df = get_store_df()
-    
-    stores_data_df = pd.merge(train_df.reset_index(), store_df.reset_index(), on="Store")
+    Returns the data aggregated by Store.
+
+    Keyword arguments:
+    chunksize -- if given, train.csv is streamed in chunks of this many rows and
+                 store.csv is joined to the aggregates, so the merged data is never built
+    """
+    if chunksize:
+        return _view(_get_derived(("stores",), lambda: _stream_stores_data_df(chunksize)))
+    return _view(_get_derived(("stores",), _build_stores_data_df))
+
+
+@instrument.timed
+def _stream_stores_data_df(chunksize):
+    stores_data_df = stream_aggregate({"Sales": ["sum"], "Customers": ["sum"], "Open": ["sum"],
+                                       "Promo": ["sum"], "SchoolHoliday": ["sum"]}, chunksize=chunksize)
+    stores_data_df.columns = stores_data_df.columns.droplevel(1)
+
+    # Stammdaten erst auf Filialebene dazu
+    store_df = get_store_df()[["StoreType", "Assortment", "CompetitionDistance", "Promo2",
+                               "PromoInterval", "CompetitionSince", "Promo2Since"]]
+    store_df = store_df.reindex(stores_data_df.index).set_axis(stores_data_df.index)
+    stores_data_df = pd.concat([stores_data_df, store_df], axis=1)
+    return _add_store_ratios(stores_data_df)
+
+
+def _iter_train_chunks(chunksize):
+    """Read train.csv in chunks with the dtypes of get_train_df, unsorted and without index."""
+    for chunk in pd.read_csv(TRAIN_CSV, parse_dates=["Date"], dtype=TRAIN_DTYPES, chunksize=chunksize):
+        chunk["isHoliday"] = chunk.StateHoliday!="0"
+        yield chunk
+
+
+@instrument.timed
+def stream_aggregate(aggregations, by=("Store",), freq=None, chunksize=CHUNK_SIZE):
+    """Aggregate train.csv chunk by chunk without loading it as a whole.
+
+    Gives the same as get_train_df().groupby(by).agg(aggregations), but only one chunk plus
+    the running aggregates are in memory at any time. "first" is the value of the earliest day.
+
+    Keyword arguments:
+    aggregations -- dict column -> list of "sum", "count", "first" and "mean"
+    by -- the columns to group by, default is Store
+    freq -- additionally group by period, e.g. "W" or "M", labeled like resample
+    chunksize -- rows per chunk
+    """
+    keys = list(by) + (["Date"] if freq else [])
+    agg_dict = {}
+    for col, funcs in aggregations.items():
+        if "sum" in funcs or "mean" in funcs:
+            agg_dict[f"{col}|sum"] = "sum"
+        if "count" in funcs or "mean" in funcs:
+            agg_dict[f"{col}|count"] = "sum"
+        if "first" in funcs:
+            agg_dict[f"{col}|first"] = "first"
+    agg_dict["|date"] = "min"
+
+    acc = None
+    for chunk in _iter_train_chunks(chunksize):
+        chunk["|date"] = chunk.Date
+        if freq:
+            chunk["Date"] = chunk.Date.dt.to_period(freq).dt.to_timestamp(how="end").dt.normalize()
+        chunk = chunk.sort_values("|date")
+
+        grouped = chunk.groupby(keys, observed=True)
+        part = pd.DataFrame({"|date": grouped["|date"].min()})
+        for name in agg_dict:
+            col, func = name.split("|")
+            if func in ["sum", "count", "first"]:
+                part[name] = getattr(grouped[col], func)()
+
+        # laufende Aggregate mit dem Chunk zusammenfalten
+        if acc is not None:
+            part = pd.concat([acc, part]).sort_values("|date").groupby(level=keys).agg(agg_dict)
+        acc = part
+
+    ans = pd.DataFrame(index=acc.index)
+    for col, funcs in aggregations.items():
+        for func in funcs:
+            if func == "mean":
+                ans[(col, func)] = acc[f"{col}|sum"] / acc[f"{col}|count"]
+            else:
+                ans[(col, func)] = acc[f"{col}|{func}"]
+    ans.columns = pd.MultiIndex.from_tuples(ans.columns)
+    return ans.sort_index()
+
+
+@instrument.timed
+def _build_stores_data_df():
+    # der gemergte Frame liegt meist schon im Cache
+    stores_data_df = get_data_df()
 
     stores_data_df = stores_data_df.groupby("Store").aggregate({
                                         # 'DayOfWeek': "sum",
@@ -99,7 +600,11 @@ def get_stores_data_df():
                                         'CompetitionSince': "first",
                                         'Promo2Since': "first",
                                     })
-    
+    return _add_store_ratios(stores_data_df)
+
+
+def _add_store_ratios(stores_data_df):
+    """Add Renovation and the per customer / per open day ratios to the aggregated store data."""
     stores_data_df.loc[:, "Renovation"] = (stores_data_df.Promo==286)
     # stores_data_df.drop("Promo", axis=1, inplace=True)
 
@@ -110,155 +615,722 @@ def get_stores_data_df():
     return stores_data_df
 
 
+@instrument.timed
+def get_store_ranking_df():
+    """Get a per-store table of totals, means and sales per customer with a rank column each.
+
+    The table is built once from train.csv and persisted next to the snapshot, so looking up
+    the rank of a store doesn't need the full training data anymore.
+    """
+    return _view(_get_derived(("ranking",), _load_store_ranking))
+
+
+def _load_store_ranking():
+    """Read the persisted ranking table if it is up to date, else build and persist it."""
+    path = os.path.join(SNAPSHOT_DIR, "ranking")
+    ranking = _read_columns(path, TRAIN_CSV) if USE_SNAPSHOT else None
+    if ranking is None:
+        ranking = _build_store_ranking()
+        if USE_SNAPSHOT:
+            _write_columns(ranking, path, TRAIN_CSV)
+    return ranking
+
+
+@instrument.timed
+def _build_store_ranking():
+    train = get_train_df()
+    grouped = train.groupby("Store")
+    grouped_open = train[train.Open==1].groupby("Store")
+
+    ranking = pd.DataFrame({
+        "sales_total": grouped.Sales.sum(),
+        "customers_total": grouped.Customers.sum(),
+        "sales_mean": grouped.Sales.mean(),
+        "sales_mean_open": grouped_open.Sales.mean(),
+        "customers_mean": grouped.Customers.mean(),
+        "customers_mean_open": grouped_open.Customers.mean(),
+    })
+    ranking["spc"] = ranking.sales_total / ranking.customers_total
+
+    # Rang = Position in der absteigend sortierten Liste (wie bisher in pms.print_store_info)
+    for col in list(ranking.columns):
+        order = ranking[col].sort_values(ascending=False).index
+        ranking[f"{col}_rank"] = pd.Series(np.arange(1, len(order) + 1), index=order)
+
+    return ranking
+
+
+def get_rollup_df(freq="D", cuboid="attributes"):
+    """Get one materialized cuboid of the rollup cube.
+
+    Sales and Customers sums and the number of open days, indexed by Date (the period's last day,
+    like resample labels it) and the dimensions of the cuboid, see ROLLUP_CUBOIDS. Built in one
+    grouped pass over the open days, persisted next to the snapshot and extended by append_sales.
+
+    Keyword arguments:
+    freq -- "D", "W" or "M"
+    cuboid -- "attributes" or "store"
+    """
+    if freq not in ROLLUP_CUBOIDS[cuboid][1]:
+        raise ValueError(f"cuboid {cuboid} is not materialized for freq {freq}")
+    return _view(_get_derived(("rollup", freq, cuboid), lambda: _load_rollup(freq, cuboid)))
+
+
+def _load_rollup(freq, cuboid):
+    """Read the persisted cuboid if it is up to date, else build and persist it."""
+    path = os.path.join(SNAPSHOT_DIR, f"rollup_{freq}_{cuboid}")
+    rollup = _read_columns(path, TRAIN_CSV) if USE_SNAPSHOT else None
+    if rollup is None:
+        rollup = _build_rollup(get_train_df(), freq, ROLLUP_CUBOIDS[cuboid][0])
+        if USE_SNAPSHOT:
+            _write_columns(rollup, path, TRAIN_CSV)
+    return rollup
+
+
+def _period_end(dates, freq):
+    """Label dates with the last day of their period, like resample(freq) does."""
+    if freq == "D":
+        return dates.normalize()
+    if freq == "W":
+        return dates.normalize() + pd.to_timedelta(6 - dates.dayofweek, unit="D")
+    if freq == "M":
+        return dates.normalize() + pd.offsets.MonthEnd(0)
+    raise ValueError(f"unsupported freq {freq}")
+
+
+@instrument.timed
+def _build_rollup(daily, freq, dims):
+    """Sum Sales and Customers and count the open days of a (Store, Date) indexed frame per period and dims.
+
+    StoreType and Assortment are taken from get_store_df, the other dims from the frame.
+    Without freq the periods are left out.
+    """
+    daily = _only_open(daily)
+    store_columns = join_store_columns(daily[[]], [dim for dim in dims if dim in ["StoreType", "Assortment"]])
+
+    keys = [] if freq is None else [_period_end(daily.index.get_level_values("Date"), freq)]
+    for dim in dims:
+        if dim in daily.index.names:
+            keys.append(daily.index.get_level_values(dim))
+        else:
+            keys.append((store_columns if dim in store_columns else daily)[dim])
+
+    rollup = daily.groupby(keys, observed=True).agg(Sales=("Sales", "sum"), Customers=("Customers", "sum"), count=("Sales", "size"))
+    rollup.index.names = ([] if freq is None else ["Date"]) + list(dims)
+    return rollup.astype("int64")
+
+
+def _extend_rollup(rollup, new, freq, dims):
+    """Add new daily rows to a cuboid, only the periods from the first new day on are regrouped."""
+    new = _build_rollup(new, freq, dims)
+    if len(new) == 0:
+        return rollup
+    dates = rollup.index.get_level_values("Date")
+    first = new.index.get_level_values("Date").min()
+    tail = pd.concat([rollup.loc[dates >= first], new]).groupby(level=list(rollup.index.names), observed=True).sum()
+    return pd.concat([rollup.loc[dates < first], tail])
+
+
+@instrument.timed
+def rollup(by=(), freq="D"):
+    """Sales and Customers sums and the number of open days per period and by, answered from the rollup cube.
+
+    Uses the smallest materialized cuboid that has all dims of by, falls back to grouping
+    the open days if there is none.
+
+    Keyword arguments:
+    by -- list of dims out of Store, StoreType, Assortment, Promo, StateHoliday and DayOfWeek
+    freq -- "D", "W", "M" or None for totals over the whole period, other pandas
+            frequencies (e.g. "Q", "2W") are resampled from the daily sums
+    """
+    by = list(by)
+    if freq not in [None, "D", "W", "M"]:
+        daily = rollup(by, "D")
+        if not by:
+            return daily.resample(freq).sum()
+        return daily.groupby([pd.Grouper(level="Date", freq=freq)] + by, observed=True).sum()
+
+    for cuboid, (dims, freqs) in ROLLUP_CUBOIDS.items():
+        if not set(by) <= set(dims):
+            continue
+        # für Gesamtsummen reicht die gröbste Auflösung
+        cube_freq = freqs[-1] if freq is None else freq
+        if cube_freq in freqs:
+            levels = ([] if freq is None else ["Date"]) + by
+            cube = get_rollup_df(cube_freq, cuboid)
+            if not levels:
+                return cube.sum().to_frame().T
+            ans = cube.groupby(level=levels, observed=True).sum()
+            break
+    else:
+        ans = _build_rollup(get_train_df(), freq, by)
+
+    # Perioden ohne geöffnete Tage wie bei resample mit 0 auffüllen
+    if freq is not None and not by:
+        ans = ans.reindex(pd.date_range(ans.index.min(), ans.index.max(), freq=freq, name="Date"), fill_value=0)
+    return ans
+
+
+@instrument.timed
 def get_weekly_data(id):
     """"Get weekly data for store id. Cut the edge weeks and renovations
     
         Keyword arguments:
         id -- store id to get data for
     """
-    train_df = get_train_df()
+    return _view(_get_derived(("weekly", id), lambda: _build_weekly_data(id)))
+
+
+def _build_weekly_data(id, start=None):
+    train_df = get_train_store_df(id)
 
     train_df = train_df.drop(["DayOfWeek", "StateHoliday"], axis=1)
-    train_df = train_df.loc[id].resample("W").sum()
+    weekly_data = _weekly_from_daily(train_df, id, start)
+
+    return weekly_data if start else get_metrics(weekly_data)
+
+
+@instrument.timed
+def _weekly_from_daily(train_df, id, start=None):
+    """Resample the daily rows of store id to weeks and add competition and promo2 info.
+
+    Keyword arguments:
+    train_df -- the daily rows of the store, Date as index
+    id -- the store id
+    start -- only build the weeks from start on to extend an existing weekly frame,
+             then only the last week is cut and renovations are not checked
+    """
+    end = train_df.index.max()
+    train_df = train_df.loc[start:].resample("W").sum()
     
     # die erste und die letzte Woche sind unvollständig
-    train_df = train_df.drop([train_df.index.min(), train_df.index.max()])
+    train_df = train_df.drop([train_df.index.max()] if start else [train_df.index.min(), train_df.index.max()])
 
     # ggf. Renovierungswochen löschen (incl. Randwochen)
-    if(train_df.loc["2014-07-13":"2014-12-28"].Open.sum()==0):
+    if start is None and (train_df.loc["2014-07-13":"2014-12-28"].Open.sum()==0):
         train_df = train_df.drop(train_df.loc["2014-07-06":"2015-01-04"].index)
 
     # ggf. Competition und Promo2 Daten einfügen
-    weekly_data = pd.merge(train_df, get_competition_and_promo2(id), left_index=True, right_index=True)
-
-    return get_metrics(weekly_data)
+    return pd.merge(train_df, get_competition_and_promo2(id, end=end), left_index=True, right_index=True)
 
+@instrument.timed
 def get_weekly_prediction_df(id):
     """"Get weekly data for store id. Cut the edge weeks and renovations
     
         Keyword arguments:
         id -- store id to get data for
     """
-    train_df = get_train_df()
+    return _view(_get_derived(("weekly_prediction", id), lambda: _build_weekly_prediction_df(id)))
+
+
+@instrument.timed
+def _build_weekly_prediction_df(id, start=None):
+    # StateHoliday ist kategorisch, die Dummies kennen also alle Kategorien
+    train_df = get_train_store_df(id)
     train_df = pd.get_dummies(train_df, columns=["StateHoliday"], drop_first=True)
 
     train_df = train_df.drop(["DayOfWeek", "Customers"], axis=1)
-    train_df = train_df.loc[id].resample("W").sum()
-    
+    return _weekly_from_daily(train_df, id, start)
+
+
+@instrument.timed
+def get_weekly_prediction_dfs(ids=None):
+    """Get the weekly prediction data of many stores at once, indexed by Store and Date.
+
+    Builds the same features as get_weekly_prediction_df, but with one grouped weekly
+    aggregation over all stores instead of one resample per store. Edge weeks and
+    renovations are cut per store. Competition and Promo2 columns are NaN for stores
+    that aren't affected by either within the observed period. PromoInterval is object
+    like per store, CompetitionDistance stays the nullable Int32 because of those NaN
+    rows (get_weekly_prediction_df gives int32).
+
+    Keyword arguments:
+    ids -- list of store ids, default is all stores
+    """
+    key = ("weekly_prediction_bulk",) + (() if ids is None else tuple(sorted(ids)))
+    return _view(_get_derived(key, lambda: _build_weekly_prediction_dfs(ids)))
+
+
+def _weekly_sum(train_df):
+    """Sum the rows of a (Store, Date) indexed frame into weeks ending on Sunday, like resample("W").
+
+    Weeks without any rows inside a store's time range are filled with zeros, as resample would."""
+    stores = train_df.index.get_level_values("Store")
+    dates = train_df.index.get_level_values("Date").normalize()
+    weeks = dates + pd.to_timedelta(6 - dates.dayofweek, unit="D")
+
+    dtypes = train_df.dtypes
+    weekly = train_df.groupby([stores, weeks]).sum()
+    weekly.index.names = ["Store", "Date"]
+
+    # Lücken (z.B. Renovierungen) wie bei resample mit 0 auffüllen
+    bounds = weekly.reset_index().groupby("Store").Date.agg(["min", "max"])
+    n_weeks = ((bounds["max"] - bounds["min"]).dt.days // 7 + 1).to_numpy()
+    offsets = np.arange(n_weeks.sum()) - np.repeat(np.cumsum(n_weeks) - n_weeks, n_weeks)
+    full_index = pd.MultiIndex.from_arrays([np.repeat(bounds.index, n_weeks),
+                                            np.repeat(bounds["min"].to_numpy(), n_weeks) + pd.to_timedelta(7 * offsets, unit="D")],
+                                           names=["Store", "Date"])
+    weekly = weekly.reindex(full_index, fill_value=0)
+
+    # resample behält die Integer-Typen bei, groupby nicht
+    int_cols = [col for col in weekly.columns if pd.api.types.is_integer_dtype(dtypes[col])]
+    return weekly.astype({col: dtypes[col] for col in int_cols})
+
+
+def _cut_edges_and_renovations(weekly):
+    """Drop the first and last week of every store and the renovation weeks of closed stores."""
+    stores = weekly.index.get_level_values("Store")
+    dates = weekly.index.get_level_values("Date")
+
     # die erste und die letzte Woche sind unvollständig
-    train_df = train_df.drop([train_df.index.min(), train_df.index.max()])
+    first = dates.to_series(index=weekly.index).groupby(level="Store").transform("min")
+    last = dates.to_series(index=weekly.index).groupby(level="Store").transform("max")
+    keep = (dates != first.to_numpy()) & (dates != last.to_numpy())
 
     # ggf. Renovierungswochen löschen (incl. Randwochen)
-    if(train_df.loc["2014-07-13":"2014-12-28"].Open.sum()==0):
-        train_df = train_df.drop(train_df.loc["2014-07-06":"2015-01-04"].index)
+    in_window = (dates >= "2014-07-13") & (dates <= "2014-12-28")
+    open_in_window = weekly.Open.where(in_window & keep, 0).groupby(level="Store").sum()
+    renovated = stores.isin(open_in_window.index[open_in_window == 0])
+    keep &= ~(renovated & (dates >= "2014-07-06") & (dates <= "2015-01-04"))
 
-    # ggf. Competition und Promo2 Daten einfügen
-    weekly_data = pd.merge(train_df, get_competition_and_promo2(id), left_index=True, right_index=True)
+    return weekly.loc[keep]
+
+
+def _competition_and_promo2_columns(index, store_df):
+    """Competition and Promo2 columns for a (Store, Date) index, like get_competition_and_promo2.
 
-    return weekly_data
+    Only stores whose CompetitionSince/Promo2Since lies within the observed period get values, else NaN.
+    """
+    attrs = store_df.reindex(index.get_level_values("Store"))
+    attrs.index = index
+    dates = index.get_level_values("Date")
+
+    ans = pd.DataFrame(index=index)
+    competition = (attrs.CompetitionSince >= "2013").to_numpy()
+    ans["Competition"] = np.where(competition, (dates >= attrs.CompetitionSince).astype("float64"), np.nan)
+    ans["CompetitionSince"] = attrs.CompetitionSince.where(competition)
+    ans["CompetitionDistance"] = attrs.CompetitionDistance.where(competition)
+
+    promo2 = (attrs.Promo2Since >= "2013").to_numpy()
+    ans["Promo2"] = np.where(promo2, (dates >= attrs.Promo2Since).astype("float64"), np.nan)
+    ans["Promo2Since"] = attrs.Promo2Since.where(promo2)
+    ans["PromoInterval"] = attrs.PromoInterval.where(promo2)
+    return ans
+
+
+@instrument.timed
+def _build_weekly_prediction_dfs(ids):
+    train_df = get_train_df()
+    if ids is not None:
+        train_df = train_df.loc[sorted(ids)]
+    train_df = pd.get_dummies(train_df, columns=["StateHoliday"], drop_first=True)
+    train_df = train_df.drop(["DayOfWeek", "Customers"], axis=1)
 
+    weekly = _cut_edges_and_renovations(_weekly_sum(train_df))
+    weekly = weekly.join(get_event_timeline_df(train_df.index.get_level_values("Date").max()).reindex(weekly.index))
+    # wie get_competition_and_promo2
+    return weekly.astype({"PromoInterval": "object"})
 
-def get_metrics(df):
+
+@instrument.timed
+def append_sales(new_rows):
+    """Append new daily rows to train.csv and update the cached data incrementally.
+
+    Only the new rows are parsed. The cached train frame, the merged frames, the store
+    aggregates of get_stores_data_df, the event timelines, the rollup cube and the per-store daily and weekly frames (incl. the
+    cumulative columns of get_metrics and the affected weekly buckets) are extended
+    instead of being rebuilt from the complete csv. Everything else is rebuilt on demand.
+    An existing snapshot is rewritten from the updated train frame.
+
+    Keyword arguments:
+    new_rows -- df or path of a csv with the columns of train.csv, every store's rows must be
+                later than its last day in train.csv
+    """
+    if isinstance(new_rows, pd.DataFrame):
+        new = new_rows[TRAIN_COLUMNS].astype(TRAIN_DTYPES)
+        new["Date"] = pd.to_datetime(new.Date)
+    else:
+        new = pd.read_csv(new_rows, parse_dates=["Date"], dtype=TRAIN_DTYPES)
+    new = _prepare_train(new.set_index(["Store", "Date"]))
+
+    train_df = _get_base("train", TRAIN_CSV, _load_train)
+    last_days = train_df.reset_index("Date").groupby(level="Store").Date.max()
+    new_last_days = last_days.reindex(new.index.get_level_values("Store"))
+    if (new.index.get_level_values("Date") <= new_last_days.to_numpy()).any():
+        raise ValueError("append_sales only appends days after the last day of each store")
+
+    # Kategorien angleichen, sonst wird StateHoliday beim concat zu object
+    categories = train_df.StateHoliday.cat.categories
+    rebuild = not new.StateHoliday.cat.categories.isin(categories).all()
+    if rebuild:
+        categories = categories.union(new.StateHoliday.cat.categories)
+        train_df = train_df.astype({"StateHoliday": pd.CategoricalDtype(categories)})
+    new = new.astype({"StateHoliday": pd.CategoricalDtype(categories)})
+
+    with open(TRAIN_CSV, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+    new.reset_index()[TRAIN_COLUMNS].to_csv(TRAIN_CSV, mode="a", header=False, index=False, date_format="%Y-%m-%d")
+
+    train_df = _freeze(_append_sorted(train_df, new))
+    _base_cache["train"] = (_source_key(TRAIN_CSV), train_df)
+    if USE_SNAPSHOT and os.path.exists(os.path.join(SNAPSHOT_DIR, "train", "meta.json")):
+        _write_columns(train_df, os.path.join(SNAPSHOT_DIR, "train"), TRAIN_CSV)
+
+    derived = list(_derived_cache.items())
+    _derived_cache.clear()
+    if rebuild:
+        return
+
+    # die Einträge in der alten Reihenfolge (LRU) unter dem neuen Schlüssel wieder einsetzen
+    sources = (_source_key(TRAIN_CSV), _source_key(STORE_CSV))
+    for key, (_, df) in derived:
+        df = _extend_derived(key[2:], df, new, last_days)
+        if df is not None:
+            _freeze(df)
+            _derived_cache[sources + key[2:]] = (int(df.memory_usage(deep=True).sum()), df)
+    _evict()
+
+
+def _extend_derived(key, df, new, last_days):
+    """Extend a cached derived frame by the new daily rows, None if it has to be rebuilt.
+
+    Keyword arguments:
+    key -- the cache key without the source keys, e.g. ("weekly", 1)
+    df -- the cached frame
+    new -- the new daily rows, typed and sorted like get_train_df
+    last_days -- the last day of every store before the new rows
+    """
+    kind, args = key[0], key[1:]
+    new_stores = new.index.unique(level="Store")
+
+    # Filialen ohne Historie haben noch keine Aggregate
+    if not new_stores.isin(last_days.index).all():
+        return None
+
+    if kind in ["data", "data_open", "data_open_compact"]:
+        merged = new if kind == "data_open_compact" else join_store_columns(new)
+        if kind != "data":
+            merged = _only_open(merged)
+        return _append_sorted(df, merged)
+
+    # hängt nur von store.csv und dem Ende des Zeitraums (Teil des Schlüssels) ab
+    if kind == "event_timeline":
+        return df
+
+    if kind == "rollup":
+        freq, cuboid = args
+        df = _extend_rollup(df, new, freq, ROLLUP_CUBOIDS[cuboid][0])
+        path = os.path.join(SNAPSHOT_DIR, f"rollup_{freq}_{cuboid}")
+        if USE_SNAPSHOT and os.path.exists(os.path.join(path, "meta.json")):
+            _write_columns(df, path, TRAIN_CSV)
+        return df
+
+    if kind == "stores":
+        sums = new.groupby(level="Store")[["Sales", "Customers", "Open", "Promo", "SchoolHoliday"]].sum()
+        df = df.copy()
+        df.loc[sums.index, sums.columns] += sums
+        return _add_store_ratios(df)
+
+    if kind not in ["store_data", "weekly", "weekly_prediction", "weekly_prediction_bulk"]:
+        return None
+    # Renovierungen werden über die ganze Historie geprüft
+    if kind != "store_data" and last_days.min() < pd.Timestamp("2015-01-04"):
+        return None
+
+    ids = args if kind == "weekly_prediction_bulk" else args[:1]
+    if kind != "weekly_prediction_bulk" or len(ids) > 0:
+        if not new_stores.isin(ids).any():
+            return df
+
+    if kind == "store_data":
+        id = args[0]
+        return _continue_metrics(df, _merge_store(new.loc[id], id))
+
+    if kind == "weekly":
+        id = args[0]
+        tail = _build_weekly_data(id, start=df.index.max() + pd.Timedelta(days=1))
+        return _continue_metrics(df, tail)
+
+    if kind == "weekly_prediction":
+        id = args[0]
+        tail = _build_weekly_prediction_df(id, start=df.index.max() + pd.Timedelta(days=1))
+        return pd.concat([df, tail])
+
+    # alle Filialen: ab dem Tag nach der jeweils letzten vollständigen Woche neu aufbauen
+    train_df = get_train_df()
+    if len(ids) > 0:
+        train_df = train_df.loc[list(ids)]
+    last_weeks = df.reset_index("Date").groupby(level="Store").Date.max()
+    if not train_df.index.unique(level="Store").isin(last_weeks.index).all():
+        return None
+    tail = train_df.loc[train_df.index.get_level_values("Date") > last_weeks.reindex(train_df.index.get_level_values("Store")).to_numpy()]
+    tail = pd.get_dummies(tail, columns=["StateHoliday"], drop_first=True)
+    tail = _weekly_sum(tail.drop(["DayOfWeek", "Customers"], axis=1))
+
+    # nur die neue letzte Woche ist unvollständig
+    last = tail.index.get_level_values("Date").to_series(index=tail.index).groupby(level="Store").transform("max")
+    tail = tail.loc[tail.index.get_level_values("Date") != last.to_numpy()]
+    tail = tail.join(get_event_timeline_df(train_df.index.get_level_values("Date").max()).reindex(tail.index))
+    return _append_sorted(df, tail.astype(df.dtypes))
+
+
+def _append_sorted(df, new):
+    """Same as pd.concat([df, new]).sort_index() for (Store, Date) frames, without sorting.
+
+    Every new row must come after the old rows of its store and new must be sorted.
+    """
+    old_stores = df.index.get_level_values("Store").to_numpy()
+    new_stores = new.index.get_level_values("Store").to_numpy()
+
+    # neue Zeilen landen hinter der letzten alten Zeile ihrer Filiale
+    insert_at = np.searchsorted(old_stores, new_stores, side="right")
+    positions = np.empty(len(df) + len(new), dtype="int64")
+    positions[np.arange(len(df)) + np.searchsorted(insert_at, np.arange(len(df)), side="right")] = np.arange(len(df))
+    positions[insert_at + np.arange(len(new))] = np.arange(len(df), len(df) + len(new))
+    return pd.concat([df, new]).take(positions)
+
+
+def _continue_metrics(df, new):
+    """Append new rows to a frame with get_metrics columns, computing them only for the new rows."""
+    if len(df) == 0:
+        return get_metrics(new)
+    # die letzte alte Zeile liefert die Basis für diff und pct_change
+    tail = get_metrics(pd.concat([df[["Sales", "Customers"]].iloc[-1:], new[["Sales", "Customers"]]]))
+    tail = tail.iloc[1:]
+    tail["cum_sales"] += df.cum_sales.iloc[-1] - df.Sales.iloc[-1]
+    tail["cum_customers"] += df.cum_customers.iloc[-1] - df.Customers.iloc[-1]
+
+    new = new.copy()
+    new[tail.columns[2:]] = tail[tail.columns[2:]]
+    return pd.concat([df, new])
+
+
+@instrument.timed
+def get_metrics(df, columns=None):
     """" Compute some business metrics.
     
         Currently: SalesPerCustomers, cummulativeSales, PercentageChangeSales, diffSales
+        The columns are added to df and run over all rows, for frames with several stores
+        use compute_metrics.
         Keyword arguments:
         df -- the data frame to compute the metrics from
+        columns -- only compute these metric columns, default is all of METRIC_COLUMNS
     """
-    df["spc"] = df.Sales / df.Customers
-    df["spc"] = df.spc.fillna(0)
-    
-    df["cum_sales"] = df.Sales.cumsum()
-    df["pct_change_sales"] = df.Sales.pct_change()
-    df["diff_sales"] = df.Sales.diff()
+    columns = METRIC_COLUMNS if columns is None else columns
 
-    df["cum_customers"] = df.Customers.cumsum()
-    df["pct_change_customers"] = df.Customers.pct_change()
-    df["diff_customers"] = df.Customers.diff()
+    if "spc" in columns:
+        df["spc"] = df.Sales / df.Customers
+        df["spc"] = df.spc.fillna(0)
+    
+    for col in ["Sales", "Customers"]:
+        name = col.lower()
+        if f"cum_{name}" in columns:
+            df[f"cum_{name}"] = df[col].cumsum()
+        if f"pct_change_{name}" in columns:
+            df[f"pct_change_{name}"] = df[col].pct_change()
+        if f"diff_{name}" in columns:
+            df[f"diff_{name}"] = df[col].diff()
     return df
 
 
-def get_competition_and_promo2(id, df=None ):
-    """"Gather competition and promo2 info if store id is affected by either.
+@instrument.timed
+def compute_metrics(df, metrics=None, windows=(), columns=("Sales",)):
+    """Compute the get_metrics columns and centered rolling means per store in one vectorized pass.
+
+    Unlike get_metrics the input is neither changed nor copied, the result is a new frame with
+    the index of df and only the computed columns. Cumulative sums, differences and percentage
+    changes restart at every store (index level or column "Store"), so all stores can be passed
+    at once. All rolling windows of a column share one cumulative sum.
+
+    Keyword arguments:
+    df -- the data, rows of a store in date order; Sales and Customers are needed for the metrics
+    metrics -- metric columns out of METRIC_COLUMNS, default is all
+    windows -- lengths of the centered rolling means (like rolling(window, center=True).mean()),
+               the columns are named "<col>_ma<window>"
+    columns -- the columns to compute the rolling means of
+    """
+    metrics = METRIC_COLUMNS if metrics is None else metrics
+    n = len(df)
+    if "Store" in df.index.names:
+        groups = df.index.get_level_values("Store").to_numpy()
+    elif "Store" in df.columns:
+        groups = df.Store.to_numpy()
+    else:
+        groups = np.zeros(n, dtype="int8")
+
+    # Filialen müssen am Stück liegen, sonst stabil danach sortieren
+    order = None
+    if n > 1 and (groups[1:] < groups[:-1]).any():
+        order = np.argsort(groups, kind="stable")
+        groups = groups[order]
+
+    def values(col):
+        col_values = df[col].to_numpy()
+        return col_values if order is None else col_values[order]
+
+    positions = np.arange(n)
+    starts = np.r_[True, groups[1:] != groups[:-1]] if n else np.zeros(0, dtype=bool)
+    ends = np.r_[groups[1:] != groups[:-1], True] if n else np.zeros(0, dtype=bool)
+    first = np.maximum.accumulate(np.where(starts, positions, 0))
+    last = np.minimum.accumulate(np.where(ends, positions, n)[::-1])[::-1]
+
+    ans = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if "spc" in metrics:
+            ans["spc"] = np.nan_to_num(values("Sales") / values("Customers"), nan=0, posinf=np.inf, neginf=-np.inf)
+
+        for col in ["Sales", "Customers"]:
+            name = col.lower()
+            if not {f"cum_{name}", f"pct_change_{name}", f"diff_{name}"} & set(metrics):
+                continue
+            col_values = values(col)
+            if f"cum_{name}" in metrics:
+                cum = np.cumsum(col_values, dtype="int64" if col_values.dtype.kind in "iub" else "float64")
+                ans[f"cum_{name}"] = cum - (cum[first] - col_values[first])
+
+            previous = np.r_[np.nan, col_values[:-1]] if n else np.zeros(0)
+            previous[starts] = np.nan
+            if f"pct_change_{name}" in metrics:
+                ans[f"pct_change_{name}"] = col_values / previous - 1
+            if f"diff_{name}" in metrics:
+                ans[f"diff_{name}"] = col_values - previous
+
+    for col in columns if len(windows) else []:
+        col_values = values(col).astype("float64")
+        missing = np.isnan(col_values)
+        sums = np.r_[0, np.cumsum(np.where(missing, 0, col_values))]
+        n_missing = np.r_[0, np.cumsum(missing)]
+        for window in windows:
+            lower = positions - window // 2
+            upper = positions + window - 1 - window // 2
+            valid = (lower >= first) & (upper <= last)
+            lower, upper = lower.clip(0, max(n - 1, 0)), upper.clip(0, max(n - 1, 0))
+            complete = (n_missing[upper + 1] - n_missing[lower]) == 0
+            ans[f"{col}_ma{window}"] = np.where(valid & complete, (sums[upper + 1] - sums[lower]) / window, np.nan)
+
+    if order is not None:
+        for name, result in ans.items():
+            unsorted = np.empty_like(result)
+            unsorted[order] = result
+            ans[name] = unsorted
+    return pd.DataFrame(ans, index=df.index)
+
+
+@instrument.timed
+def get_competition_and_promo2(id, df=None, end="2015-7-31"):
+    """"Gather weekly competition and promo2 info if store id is affected by either.
+
+        Competition/Promo2 is 1 for the weeks ending on or after the event, 0 before.
+        Only the columns of events within the observed period are returned.
     
         Keyword arguments:
         id -- the store id
         df -- the data to get the info from, 
-              if no df is provided we take get_store_df() by default
+              if no df is provided we take the cached get_event_timeline_df() if it was
+              built already, else only the row of store id in get_store_df()
+        end -- the last day of the observed period
     """
-    ans = pd.DataFrame(index=pd.date_range("2013-1-1", "2015-7-31"))
+    end = pd.Timestamp(end)
+    timeline = _peek_derived(("event_timeline", end)) if df is None else None
+    if timeline is None:
+        # ohne gecachte Zeitleiste nur diese Filiale aufbauen, sonst zahlt der erste Aufruf für alle
+        timeline = _build_event_timeline((get_store_df() if df is None else df).loc[[id]], end)
+    # ohne Namen wie bisher, das Prognose-Notebook erwartet nach reset_index() die Spalte "index"
+    ans = timeline.loc[id].rename_axis(None)
 
-    if df==None:
-        df = get_store_df()
+    # CompetitionSince und Promo2Since sind nur interessant, wenn sie im Beobachtungszeitraum liegen
+    columns = []
+    if ans.CompetitionSince.notna().any():
+        columns += ["Competition", "CompetitionSince", "CompetitionDistance"]
+    if ans.Promo2Since.notna().any():
+        columns += ["Promo2", "Promo2Since", "PromoInterval"]
 
-    aggregation_dict = {}
+    # Typen wie bei der früheren tageweisen Variante
+    casts = {}
+    if "CompetitionDistance" in columns and ans.CompetitionDistance.notna().all():
+        casts["CompetitionDistance"] = ans.CompetitionDistance.astype("int32")
+    if "PromoInterval" in columns:
+        casts["PromoInterval"] = ans.PromoInterval.astype("object")
+    return ans[columns].assign(**casts)
 
-    # CompetitionSince und Promo2Since sind nur interessant, wenn sie im Beobachtungszeitraum liegen
-    if not pd.isnull(df.loc[id].CompetitionSince):
-        if df.loc[id].CompetitionSince>=pd.Timestamp("2013"):
-            ans.loc[df.loc[id].CompetitionSince:, "Competition"] = 1
-            ans.loc[:, "CompetitionSince"] = df.loc[id].CompetitionSince
-            ans.loc[:, "CompetitionDistance"] = df.loc[id].CompetitionDistance
-            aggregation_dict = {"Competition": "sum", "CompetitionSince": "first", "CompetitionDistance": "first"}
-
-    if not pd.isnull(df.loc[id].Promo2Since):    
-        if df.loc[id].Promo2Since>=pd.Timestamp("2013"):
-            ans.loc[(df.loc[id].Promo2Since):, "Promo2"] = 1
-            ans.loc[:, "Promo2Since"] = df.loc[id].Promo2Since
-            ans.loc[:, "PromoInterval"] = df.loc[id].PromoInterval
-            aggregation_dict["Promo2"] = "sum"
-            aggregation_dict["Promo2Since"] = "first"
-            aggregation_dict["PromoInterval"] = "first"
-
-    if len(aggregation_dict) == 0:
-        ans = ans.resample("W").sum()
-    else:
-        ans = ans.fillna(0)
-        ans.resample("W").agg(aggregation_dict)
-    return ans
 
+@instrument.timed
+def get_event_timeline_df(end="2015-7-31"):
+    """Weekly Competition and Promo2 exposure of all stores, indexed by Store and Date (week ending Sunday).
 
+    Built once from the store.csv attributes and cached, get_competition_and_promo2 and
+    the weekly pipelines join their rows instead of rebuilding them per store. Columns of
+    events outside the observed period are NaN.
+
+    Keyword arguments:
+    end -- the last day of the observed period
+    """
+    end = pd.Timestamp(end)
+    return _view(_get_derived(("event_timeline", end), lambda: _build_event_timeline(get_store_df(), end)))
 
+
+def _build_event_timeline(store_df, end):
+    weeks = pd.date_range("2013-1-1", end, freq="W")
+    index = pd.MultiIndex.from_product([store_df.index, weeks], names=["Store", "Date"])
+    return _competition_and_promo2_columns(index, store_df)
+
+
+@instrument.timed
 def get_impact_df(df, data_type="competition"):
     """"Gather sales and customer info before and after some event.
     
         This is a generalization of the deprecated get_competition_impact.
+        All stores are handled at once: the split point per store is found in one pass
+        over the sorted rows and the sums come from cumulative sums.
+
         Keyword arguments:
-        df -- the data frame to plot from
+        df -- the data frame to plot from, compact frames get the store columns joined
         data_type -- type of the event, default is "competition", "promo2" is the other valid option atm 
     """
     data_column = f"{data_type.capitalize()}Since"
-    data_stores = df.loc[df[data_column] >= "2013"].index.unique(level="Store").to_list()
-    
-    """"Only competition has a distance."""
-    if data_type=="competition":
-        impact_df = pd.DataFrame(columns="store competition_since competition_distance pre_days post_days pre_sales post_sales pre_customers post_customers".split())
-    else:
-        impact_df = pd.DataFrame(columns=f"store {data_type}_since pre_days post_days pre_sales post_sales pre_customers post_customers".split())
-    
-    impact_df = impact_df.set_index("store")
+    if data_column not in df.columns:
+        df = join_store_columns(df, [data_column, "CompetitionDistance"] if data_type=="competition" else [data_column])
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
 
-    for store in data_stores:
-        data_since = df.loc[store, data_column][0]
-        my_dict = {f"{data_type}_since": data_since}
+    stores = df.index.get_level_values("Store").to_numpy()
+    dates = df.index.get_level_values("Date").to_numpy()
 
-        if data_type=="competition":
-            data_distance = df.loc[store, f"{data_type.capitalize()}Distance"][0]
-            my_dict[f"{data_type}_distance"] = data_distance
+    # jede Filiale ist ein zusammenhängender Block [starts, stops)
+    starts = np.flatnonzero(np.r_[True, stores[1:] != stores[:-1]])
+    stops = np.r_[starts[1:], len(stores)]
 
-        pre_data_df = df.loc[(store, slice(None, data_since)), :]
-        post_data_df = df.loc[(store, slice(data_since, None)), :]
+    # Since ist je Filiale konstant, NaT vergleicht immer als False
+    since = df[data_column].to_numpy()[starts]
+    row_since = np.repeat(since, stops - starts)
 
-        my_dict["pre_days"] = pre_data_df.shape[0]
-        my_dict["post_days"] = post_data_df.shape[0]
+    # Datum ist innerhalb einer Filiale sortiert, also sind pre und post Präfix bzw. Suffix des Blocks.
+    # Wie bei den .loc Slices zählt der Tag des Events zu beiden Seiten.
+    pre_stops = starts + np.add.reduceat((dates <= row_since).astype("int64"), starts)
+    post_starts = starts + np.add.reduceat((dates < row_since).astype("int64"), starts)
 
-        my_dict["pre_sales"] = pre_data_df.Sales.sum()
-        my_dict["post_sales"] = post_data_df.Sales.sum()
+    affected = since >= np.datetime64("2013")
+    starts, stops, pre_stops, post_starts = starts[affected], stops[affected], pre_stops[affected], post_starts[affected]
+
+    impact_df = pd.DataFrame(index=pd.Index(stores[starts], dtype="int64", name="store"))
+    impact_df[f"{data_type}_since"] = since[affected]
+
+    """"Only competition has a distance."""
+    if data_type=="competition":
+        data_distance = df[f"{data_type.capitalize()}Distance"].iloc[starts]
+        if not data_distance.isna().any():
+            data_distance = data_distance.astype(getattr(data_distance.dtype, "numpy_dtype", data_distance.dtype))
+        impact_df[f"{data_type}_distance"] = data_distance.to_numpy()
 
-        my_dict["pre_customers"] = pre_data_df.Customers.sum()
-        my_dict["post_customers"] = post_data_df.Customers.sum()
+    impact_df["pre_days"] = pre_stops - starts
+    impact_df["post_days"] = stops - post_starts
 
-        impact_df.loc[store] = my_dict
+    for col in ["Sales", "Customers"]:
+        cum = np.r_[0, df[col].to_numpy(dtype="int64").cumsum()]
+        impact_df[f"pre_{col.lower()}"] = cum[pre_stops] - cum[starts]
+        impact_df[f"post_{col.lower()}"] = cum[stops] - cum[post_starts]
 
     impact_df[f"pre_daily_mean_sales"] = impact_df["pre_sales"] / impact_df["pre_days"]
     impact_df[f"post_daily_mean_sales"] = impact_df["post_sales"] / impact_df["post_days"]
@@ -0,0 +1,300 @@
+"""Serve 8-week sales forecasts per store from a registry of fitted models.
+
+    python serve.py build --results model_selection/results.csv --jobs 4
+    python serve.py predict 1 2 3
+    python serve.py http --port 8000
+
+The registry holds the best model per store (from forecast.select_models, fitted on all
+weeks) together with the scaled feature rows of the next weeks, so a forecast is a
+single predict call on data that is already in memory.
+"""
+import argparse
+import json
+import os
+import pickle
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+import forecast
+import rms
+
+
+REGISTRY_DIR = "model_registry"
+HORIZON = forecast.TEST_WEEKS
+DEFAULT_MODEL = "LinearRegression"
+
+
+def future_features(weekly_data, horizon=HORIZON):
+    """Feature rows of the horizon weeks after the last week of one store.
+
+    Open, Promo and holiday columns are taken from the same week one year earlier (52 weeks),
+    Competition and Promo2 are 1 from their start date on, like in the history.
+
+    Keyword arguments:
+    weekly_data -- the weekly prediction data of one store, Date as index
+    horizon -- number of weeks to forecast
+    """
+    last = weekly_data.index.max()
+    dates = pd.date_range(last + pd.Timedelta(weeks=1), periods=horizon, freq="W", name="Date")
+
+    # dieselbe Woche im Vorjahr, sonst die letzte bekannte Woche
+    previous_year = weekly_data.reindex(dates - pd.Timedelta(weeks=52))
+    previous_year = previous_year.fillna(weekly_data.iloc[-1])
+    future = previous_year.set_axis(dates).astype(weekly_data.dtypes.to_dict())
+    future["Sales"] = 0
+
+    if "Competition" in future.columns:
+        future["Competition"] = (dates >= weekly_data.CompetitionSince.iloc[-1]).astype("float64")
+    if "Promo2" in future.columns:
+        future["Promo2"] = (dates >= weekly_data.Promo2Since.iloc[-1]).astype("float64")
+    return future
+
+
+def fit_store_model(store, weekly_data, model_name=DEFAULT_MODEL, horizon=HORIZON):
+    """Fit model_name on all weeks of one store and return its registry entry.
+
+    Keyword arguments:
+    store -- the store id
+    weekly_data -- the weekly prediction data of the store, Date as index
+    model_name -- a model from forecast.MODELS
+    horizon -- number of weeks to forecast
+    """
+    # im Sammel-Frame haben nicht betroffene Filialen leere Competition/Promo2 Spalten
+    weekly_data = weekly_data.dropna(axis=1, how="all")
+    history = forecast.get_date_stuff(weekly_data.loc[weekly_data.Sales>0])
+    X, y = forecast.prepare_x_and_y(history)
+    X_future, _ = forecast.prepare_x_and_y(forecast.get_date_stuff(future_features(weekly_data, horizon)))
+
+    scaler = StandardScaler()
+    X_scaled = pd.DataFrame(scaler.fit_transform(X), index=X.index, columns=X.columns)
+    X_future_scaled = pd.DataFrame(scaler.transform(X_future[X.columns]), index=X_future.index, columns=X.columns)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        model = forecast.MODELS[model_name]().fit(X_scaled, y)
+    return {"store": store, "model_name": model_name, "model": model, "X_future": X_future_scaled,
+            "trained_until": str(weekly_data.index.max().date())}
+
+
+def _fit_task(store, weekly_data, model_name, horizon, registry_dir):
+    entry = fit_store_model(store, weekly_data, model_name, horizon)
+    with open(os.path.join(registry_dir, f"{store}.pkl"), "wb") as f:
+        pickle.dump(entry, f)
+    return store, {"model_name": entry["model_name"], "trained_until": entry["trained_until"]}
+
+
+def _load_index(registry_dir):
+    path = os.path.join(registry_dir, "index.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return {int(store): info for store, info in json.load(f).items()}
+
+
+def build_registry(results=None, ids=None, metric="mae", registry_dir=REGISTRY_DIR, n_jobs=1, horizon=HORIZON, only_stale=False):
+    """Fit the best model of every store on all its weeks and persist it with its future feature rows.
+
+    Keyword arguments:
+    results -- results of forecast.select_models (df or csv path), stores without results get DEFAULT_MODEL
+    ids -- list of store ids, default is all stores
+    metric -- the metric to pick the best model by
+    registry_dir -- where the models and index.json are written
+    n_jobs -- number of worker processes, 1 fits in-process
+    horizon -- number of weeks to forecast
+    only_stale -- only refit stores that have newer weekly data than their registered model
+    """
+    os.makedirs(registry_dir, exist_ok=True)
+    if isinstance(results, str):
+        results = pd.read_csv(results)
+    best = {} if results is None else forecast.get_best_models(results, metric).model.to_dict()
+
+    weekly = rms.get_weekly_prediction_dfs(ids)
+    index = _load_index(registry_dir)
+    last_weeks = weekly.reset_index("Date").groupby(level="Store").Date.max()
+
+    tasks = []
+    for store, last_week in last_weeks.items():
+        store = int(store)
+        if only_stale and store in index and index[store]["trained_until"] >= str(last_week.date()):
+            continue
+        model_name = best.get(store, index.get(store, {}).get("model_name", DEFAULT_MODEL))
+        tasks.append((store, weekly.loc[store], model_name, horizon, registry_dir))
+
+    if n_jobs == 1:
+        done = [_fit_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            done = list(pool.map(_fit_task, *zip(*tasks))) if tasks else []
+
+    index.update(done)
+    with open(os.path.join(registry_dir, "index.json"), "w") as f:
+        json.dump({str(store): info for store, info in sorted(index.items())}, f, indent=1)
+    return pd.DataFrame.from_dict(index, orient="index").rename_axis("store")
+
+
+class ForecastService:
+    """Forecasts from a model registry, cached in memory.
+
+    Models are loaded on first use (or all at once with warm()), forecasts are computed once
+    per store and then served from the cache until refresh() swaps in newly fitted models.
+    """
+
+    def __init__(self, registry_dir=REGISTRY_DIR):
+        self.registry_dir = registry_dir
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+        self._load()
+
+    def _load(self, warm_ids=()):
+        """Read the registry index and compute the forecasts of warm_ids, then swap them in at once."""
+        index = _load_index(self.registry_dir)
+        forecasts = {store: self._predict(self._read_entry(store)) for store in warm_ids if store in index}
+        with self._lock:
+            self.index, self._forecasts = index, forecasts
+
+    def _read_entry(self, store):
+        with open(os.path.join(self.registry_dir, f"{store}.pkl"), "rb") as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def _predict(entry):
+        return pd.DataFrame({"store": entry["store"], "date": entry["X_future"].index,
+                             "sales": entry["model"].predict(entry["X_future"]),
+                             "model": entry["model_name"]})
+
+    def _forecast(self, store):
+        forecast_df = self._forecasts.get(store)
+        if forecast_df is None:
+            if store not in self.index:
+                raise KeyError(f"store {store} is not in the registry")
+            forecast_df = self._forecasts[store] = self._predict(self._read_entry(store))
+        return forecast_df
+
+    def warm(self, ids=None):
+        """Load the models and compute the forecasts of ids (default all stores) ahead of the first request."""
+        for store in self.index if ids is None else ids:
+            self._forecast(int(store))
+        return self
+
+    def predict(self, stores):
+        """Forecasts of one or many stores as df with store, date, sales and model."""
+        stores = [stores] if isinstance(stores, int) else stores
+        return pd.concat([self._forecast(int(store)) for store in stores], ignore_index=True)
+
+    def refresh(self, background=True, **kwargs):
+        """Refit stores with new weekly data (e.g. after rms.append_sales) and reload the registry.
+
+        Requests are served from the old models until the refit is done.
+
+        Keyword arguments:
+        background -- refit in a thread and return immediately
+        kwargs -- passed to build_registry, by default only stale models of the registered stores are refit
+        """
+        kwargs = {"ids": list(self.index), "only_stale": True, **kwargs}
+
+        def run():
+            build_registry(registry_dir=self.registry_dir, **kwargs)
+            # die bisher gecachten Filialen werden vor dem Umschalten neu berechnet
+            self._load(warm_ids=list(self._forecasts))
+
+        if not background:
+            run()
+            return None
+        if self._refresh_thread is None or not self._refresh_thread.is_alive():
+            self._refresh_thread = threading.Thread(target=run, daemon=True)
+            self._refresh_thread.start()
+        return self._refresh_thread
+
+
+def _handler(service):
+    class ForecastHandler(BaseHTTPRequestHandler):
+        """GET /forecast?store=1&store=2, POST /forecast {"stores": [1, 2]}, POST /refresh."""
+
+        def _send(self, status, body):
+            data = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _forecast(self, stores):
+            start = time.perf_counter()
+            try:
+                stores = [int(store) for store in stores]
+            except (TypeError, ValueError):
+                return self._send(400, {"error": "stores must be a list of store ids"})
+            if not stores:
+                return self._send(400, {"error": "no stores given"})
+            try:
+                forecasts = service.predict(stores)
+            except KeyError as e:
+                return self._send(404, {"error": str(e.args[0])})
+            self._send(200, {"forecasts": forecasts.to_dict(orient="records"),
+                             "ms": round(1000 * (time.perf_counter() - start), 3)})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/forecast":
+                return self._send(404, {"error": "unknown path"})
+            self._forecast(parse_qs(url.query).get("store", []))
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path == "/refresh":
+                service.refresh()
+                return self._send(202, {"status": "refreshing"})
+            if url.path != "/forecast":
+                return self._send(404, {"error": "unknown path"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stores = body.get("stores", [])
+            except (ValueError, AttributeError):
+                # json.JSONDecodeError ist ein ValueError, AttributeError wenn der Body kein Objekt ist
+                return self._send(400, {"error": 'body must be a json object like {"stores": [1, 2]}'})
+            self._forecast(stores)
+
+    return ForecastHandler
+
+
+def serve(host="127.0.0.1", port=8000, registry_dir=REGISTRY_DIR):
+    """Serve forecasts over HTTP, all models are loaded and forecasts computed before the first request."""
+    service = ForecastService(registry_dir).warm()
+    server = ThreadingHTTPServer((host, port), _handler(service))
+    print(f"serving {len(service.index)} stores on http://{host}:{port}/forecast")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--registry-dir", default=REGISTRY_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="fit the best model per store and write the registry")
+    build.add_argument("--results", help="results.csv of forecast.py select")
+    build.add_argument("--stores", type=int, nargs="+")
+    build.add_argument("--metric", default="mae", choices=["mae", "mape", "rmse", "r2"])
+    build.add_argument("--jobs", type=int, default=1)
+    build.add_argument("--only-stale", action="store_true", help="only refit stores with new weekly data")
+
+    predict = subparsers.add_parser("predict", help="print the forecasts of some stores")
+    predict.add_argument("stores", type=int, nargs="+")
+
+    http = subparsers.add_parser("http", help="serve forecasts over HTTP")
+    http.add_argument("--host", default="127.0.0.1")
+    http.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(build_registry(args.results, args.stores, args.metric, args.registry_dir, args.jobs, only_stale=args.only_stale))
+    elif args.command == "predict":
+        print(ForecastService(args.registry_dir).predict(args.stores))
+    else:
+        serve(args.host, args.port, args.registry_dir)